@@ -0,0 +1,302 @@
+# Copyright 2009-2010 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An event loop front end for sleepy.mongoose.
+
+One thread multiplexes every client socket with asyncore (using poll, so we
+aren't capped at FD_SETSIZE); a socket only costs a worker thread while a
+complete request is actually being run.  Requests are run by the regular
+request handler class against in-memory streams, so the uri grammar and the
+MongoHandler operations are exactly the same as with HTTPServer.
+
+That also means a request's whole body, Content-Length or chunked, is read
+into memory before it's run: streamed bodies (ndjson and bson _inserts) are
+still parsed a document at a time, but they don't start going to the db
+until the client has sent everything.
+"""
+
+from pool import WorkerPool
+
+import asyncore
+import asynchat
+import collections
+import os
+import socket
+import sys
+import traceback
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+
+class MongoBufferedRequestMixIn:
+    """
+    run a single, already read, request and keep the response in memory
+    """
+
+    def setup(self):
+        self.rfile = StringIO(self.request)
+        self.wfile = StringIO()
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+
+    def finish(self):
+        pass
+
+
+class MongoAsyncChannel(asynchat.async_chat):
+
+    max_header_size = 65536
+
+    def __init__(self, sock, client_address, server):
+        asynchat.async_chat.__init__(self, sock, map = server.map)
+        self.client_address = client_address
+        self.server = server
+        self.data = []
+        self.size = 0
+        self.header = None
+        # where we are in a chunked body, None if we aren't in one
+        self.chunk_state = None
+        self.chunks = []
+        self.pending = collections.deque()
+        self.busy = False
+        self.set_terminator("\r\n\r\n")
+
+    def collect_incoming_data(self, data):
+        self.data.append(data)
+        self.size = self.size + len(data)
+        # headers, chunk sizes and trailers are all lines we wait for the
+        # end of
+        if self.header == None or self.chunk_state not in (None, "data"):
+            if self.size > self.max_header_size:
+                self.close()
+
+    def found_terminator(self):
+        data = "".join(self.data)
+        self.data = []
+        self.size = 0
+
+        if self.header == None:
+            self.header = data + "\r\n\r\n"
+
+            encoding = self._header_value(self.header, "transfer-encoding")
+            if encoding != None and encoding.lower() == "chunked":
+                self.chunk_state = "size"
+                self.set_terminator("\r\n")
+                return
+
+            try:
+                length = int(self._header_value(self.header, "content-length") or 0)
+            except ValueError:
+                length = 0
+            if length > 0:
+                self.set_terminator(length)
+                return
+            data = ""
+        elif self.chunk_state != None:
+            if not self._found_chunk_part(data):
+                return
+            data = "".join(self.chunks)
+            self.chunks = []
+            self.chunk_state = None
+            self.header = self._dechunked_header(self.header, len(data))
+
+        self.pending.append(self.header + data)
+        self.header = None
+        self.set_terminator("\r\n\r\n")
+
+        self._run_next()
+
+    def _found_chunk_part(self, data):
+        """
+        move through a chunked body, returns True once it's all been read
+        """
+        if self.chunk_state == "size":
+            try:
+                length = int(data.split(";")[0].strip(), 16)
+            except ValueError:
+                self._bad_request()
+                return False
+
+            if length == 0:
+                self.chunk_state = "trailer"
+                self.set_terminator("\r\n")
+            else:
+                self.chunk_state = "data"
+                self.set_terminator(length)
+        elif self.chunk_state == "data":
+            self.chunks.append(data)
+            self.chunk_state = "end"
+            self.set_terminator("\r\n")
+        elif self.chunk_state == "end":
+            self.chunk_state = "size"
+        elif self.chunk_state == "trailer":
+            # trailers are dropped, an empty line ends the body
+            return len(data) == 0
+
+        return False
+
+    def _dechunked_header(self, header, length):
+        """
+        the request run from the buffer is framed by its length instead
+        """
+        lines = []
+        for line in header[:-4].split("\r\n"):
+            key = line.partition(":")[0].strip().lower()
+            if key != "transfer-encoding" and key != "content-length":
+                lines.append(line)
+        lines.append("Content-Length: %d" % length)
+        return "\r\n".join(lines) + "\r\n\r\n"
+
+    def _header_value(self, header, name):
+        for line in header.split("\r\n")[1:]:
+            (key, colon, value) = line.partition(":")
+            if key.strip().lower() == name:
+                return value.strip()
+        return None
+
+    def _bad_request(self):
+        self.push("HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        self.close_when_done()
+        # ignore whatever else comes in
+        self.set_terminator(None)
+        self.header = None
+        self.chunk_state = None
+        self.chunks = []
+
+    def _run_next(self):
+        """
+        requests on one connection are answered in the order they came in,
+        so only one of them is handed to the pool at a time
+        """
+        if self.busy or len(self.pending) == 0:
+            return
+
+        self.busy = True
+        self.server.pool.submit(self.server.run_request, self, self.pending.popleft())
+
+    def request_done(self, response, close):
+        self.busy = False
+        self.push(response)
+
+        if close:
+            self.close_when_done()
+        else:
+            self._run_next()
+
+    def handle_error(self):
+        self.server.handle_error(self.client_address)
+        self.close()
+
+
+class MongoAsyncWaker(asyncore.file_dispatcher):
+    """
+    lets worker threads wake the event loop up to send their responses
+    """
+
+    def __init__(self, map, callback):
+        (self.read_fd, self.write_fd) = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.read_fd, map = map)
+        self.callback = callback
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except (OSError, socket.error):
+            pass
+        self.callback()
+
+    def wake(self):
+        os.write(self.write_fd, "x")
+
+
+class MongoAsyncServer(asyncore.dispatcher):
+
+    pool_size = 10
+
+    def __init__(self, server_address, HandlerClass):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map = self.map)
+
+        class MongoBufferedRequest(MongoBufferedRequestMixIn, HandlerClass):
+            pass
+        self.RequestClass = MongoBufferedRequest
+
+        self.pool = None
+        self.done = collections.deque()
+        self.waker = None
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(1024)
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+
+        if pair == None:
+            return
+
+        (sock, client_address) = pair
+        MongoAsyncChannel(sock, client_address, self)
+
+    def run_request(self, channel, raw):
+        """
+        called on a worker thread
+        """
+        try:
+            request = self.RequestClass(raw, channel.client_address, self)
+            response = request.wfile.getvalue()
+            close = request.close_connection
+        except:
+            self.handle_error(channel.client_address)
+            response = ""
+            close = True
+
+        self.done.append((channel, response, close))
+        self.waker.wake()
+
+    def finish_requests(self):
+        """
+        hand finished responses back to their channels, on the loop thread
+        """
+        while len(self.done) > 0:
+            (channel, response, close) = self.done.popleft()
+            if channel.connected:
+                channel.request_done(response, close)
+
+    def handle_error(self, client_address = None):
+        print >>sys.stderr, '-'*40
+        print >>sys.stderr, 'Exception happened during processing of request from',
+        print >>sys.stderr, client_address
+        traceback.print_exc()
+        print >>sys.stderr, '-'*40
+
+    def serve_forever(self):
+        # threads and the waker's pipe are made here rather than in
+        # __init__, so each prefork worker gets its own
+        self.pool = WorkerPool(MongoAsyncServer.pool_size, "mongoose")
+        self.waker = MongoAsyncWaker(self.map, self.finish_requests)
+        asyncore.loop(timeout = 30, use_poll = True, map = self.map)
@@ -0,0 +1,198 @@
+# Copyright 2009-2010 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+
+import threading
+import time
+
+class MongoQueryCache:
+    """
+    encoded _find results, by normalized query.  entries expire after ttl
+    seconds, the least recently used ones are evicted to stay under
+    max_bytes, and every entry for a collection is dropped when something
+    writes to it through us.
+
+    namespaces are (connection name, db, collection) tuples.
+    """
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        # key -> (expires, size, ns, docs), least recently used first
+        self.entries = OrderedDict()
+        # ns -> set of keys
+        self.namespaces = {}
+        self.size = 0
+
+        # bumped by every invalidation, so a query that was running while
+        # something wrote to the db doesn't get cached
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry == None:
+                self.misses = self.misses + 1
+                return None
+
+            if entry[0] < time.time():
+                self._forget(key, entry)
+                self.expirations = self.expirations + 1
+                self.misses = self.misses + 1
+                return None
+
+            self.entries[key] = entry
+            self.hits = self.hits + 1
+            return entry[3]
+        finally:
+            self.lock.release()
+
+    def put(self, key, ns, docs, generation):
+        """
+        docs is a list of encoded documents, generation is what
+        self.generation was before the query ran
+        """
+        size = len(key)
+        for doc in docs:
+            size = size + len(doc)
+
+        if size > self.max_bytes:
+            return
+
+        self.lock.acquire()
+        try:
+            if generation != self.generation:
+                return
+
+            old = self.entries.pop(key, None)
+            if old != None:
+                self._forget(key, old)
+
+            self.entries[key] = (time.time() + self.ttl, size, ns, docs)
+            self.namespaces.setdefault(ns, set()).add(key)
+            self.size = self.size + size
+
+            while self.size > self.max_bytes:
+                (old_key, old) = self.entries.popitem(last = False)
+                self._forget(old_key, old)
+                self.evictions = self.evictions + 1
+        finally:
+            self.lock.release()
+
+    def invalidate(self, name, db, collection = None):
+        """
+        drop everything cached for a collection, or for a whole db if
+        collection is None
+        """
+        self.lock.acquire()
+        try:
+            self.generation = self.generation + 1
+
+            for ns in self.namespaces.keys():
+                if ns[0] != name or ns[1] != db:
+                    continue
+                if collection != None and ns[2] != collection:
+                    continue
+
+                for key in list(self.namespaces[ns]):
+                    entry = self.entries.pop(key)
+                    self._forget(key, entry)
+                    self.invalidations = self.invalidations + 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.generation = self.generation + 1
+            self.invalidations = self.invalidations + len(self.entries)
+            self.entries.clear()
+            self.namespaces.clear()
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {"entries" : len(self.entries), "bytes" : self.size,
+                "hits" : self.hits, "misses" : self.misses,
+                "evictions" : self.evictions, "expirations" : self.expirations,
+                "invalidations" : self.invalidations}
+
+    def _forget(self, key, entry):
+        # entry has already been taken out of self.entries
+        self.size = self.size - entry[1]
+
+        keys = self.namespaces.get(entry[2])
+        if keys != None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.namespaces[entry[2]]
+
+
+class MongoPlanCache:
+    """
+    the least recently used max_entries of whatever was worked out from a
+    request (parsed uris and query arguments, say), so a request that's
+    the same as a recent one doesn't have to work it out again.  values
+    are shared between requests, so they mustn't be changed.
+    """
+
+    def __init__(self, max_entries = 1000):
+        self.max_entries = max_entries
+
+        # key -> plan, least recently used first
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            plan = self.entries.pop(key, None)
+            if plan == None:
+                self.misses = self.misses + 1
+                return None
+
+            self.entries[key] = plan
+            self.hits = self.hits + 1
+            return plan
+        finally:
+            self.lock.release()
+
+    def put(self, key, plan):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = plan
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {"entries" : len(self.entries), "hits" : self.hits, "misses" : self.misses}
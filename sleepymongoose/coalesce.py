@@ -0,0 +1,124 @@
+# Copyright 2009-2010 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pool import WorkerPool
+
+import sys
+import threading
+import time
+
+class MongoInsertBatch:
+    """
+    documents from several requests waiting to be inserted together
+    """
+
+    def __init__(self, key, deadline):
+        self.key = key
+        self.deadline = deadline
+        self.docs = []
+        self.done = threading.Event()
+        self.n = 0
+        self.errors = []
+
+
+class MongoInsertCoalescer:
+    """
+    gathers small inserts into the same namespace for up to window seconds,
+    or until there are max_docs of them, and sends them to the db as one
+    unordered insert.  flush(key, docs) does the inserting and returns how
+    many docs went in and the write errors, with each error's index into
+    docs.
+    """
+
+    def __init__(self, flush, window = 0.005, max_docs = 100, threads = 4):
+        self.flush = flush
+        self.window = window
+        self.max_docs = max_docs
+
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+
+        self.pool = WorkerPool(threads, "coalesce")
+        self.flusher = threading.Thread(target = self._run, name = "coalesce-timer")
+        self.flusher.setDaemon(True)
+        self.flusher.start()
+
+    def insert(self, key, docs, wait = True):
+        """
+        queue docs to be inserted into key's namespace.  if wait is set,
+        block until they've been sent and return the write errors for
+        them, with indexes into docs.  otherwise return None right away.
+        """
+        full = None
+        self.lock.acquire()
+        try:
+            batch = self.pending.get(key)
+            if batch == None:
+                batch = MongoInsertBatch(key, time.time() + self.window)
+                self.pending[key] = batch
+                self.wakeup.notify()
+
+            offset = len(batch.docs)
+            batch.docs.extend(docs)
+
+            if len(batch.docs) >= self.max_docs:
+                del self.pending[key]
+                full = batch
+        finally:
+            self.lock.release()
+
+        if full != None:
+            self.pool.submit(self._flush, full)
+
+        if not wait:
+            return None
+
+        batch.done.wait()
+
+        errors = []
+        for error in batch.errors:
+            if "index" not in error:
+                # not about any one document, so it's everyone's
+                errors.append(error)
+            elif offset <= error["index"] < offset + len(docs):
+                error = dict(error)
+                error["index"] = error["index"] - offset
+                errors.append(error)
+        return errors
+
+    def _run(self):
+        self.lock.acquire()
+        try:
+            while True:
+                now = time.time()
+                timeout = None
+                for (key, batch) in self.pending.items():
+                    if batch.deadline <= now:
+                        del self.pending[key]
+                        self.pool.submit(self._flush, batch)
+                    elif timeout == None or batch.deadline - now < timeout:
+                        timeout = batch.deadline - now
+
+                self.wakeup.wait(timeout)
+        finally:
+            self.lock.release()
+
+    def _flush(self, batch):
+        try:
+            (batch.n, batch.errors) = self.flush(batch.key, batch.docs)
+        except:
+            # there's no one to raise it to but the callers
+            batch.errors = [{"errmsg" : "%s" % sys.exc_info()[1]}]
+        batch.done.set()
@@ -0,0 +1,102 @@
+# Copyright 2009-2010 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Extended json encoding and decoding for everything the handlers send and
+receive.
+
+simplejson is used for encoding when its C speedups are installed, the json
+module otherwise; both are set up to produce exactly the same output.  Encoders
+and decoders are built once instead of on every call, and ObjectIds, by
+far the most common BSON value, skip json_util's chain of isinstance
+checks.
+"""
+
+from bson import json_util
+from bson.objectid import ObjectId
+
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import simplejson
+    if getattr(simplejson.encoder, "c_make_encoder", None) == None:
+        simplejson = None
+except ImportError:
+    simplejson = None
+
+def _default(obj):
+    if type(obj) is ObjectId:
+        return {"$oid" : str(obj)}
+    return json_util.default(obj)
+
+# seconds each thread has spent in dumps, for metrics
+timing = threading.local()
+
+# the backend's name, and its encoders and decoder
+backend = None
+_encoder = None
+_sorted_encoder = None
+_decoder = None
+
+def use(name):
+    """
+    switch to the "json" or "simplejson" backend
+    """
+    global backend, _encoder, _sorted_encoder, _decoder
+
+    if name == "simplejson":
+        if simplejson == None:
+            raise ValueError("simplejson with C speedups isn't installed")
+        module = simplejson
+        # whatever the json module would do with these is what we want.
+        # newer simplejsons refuse NaN and Infinity unless told otherwise
+        options = {"use_decimal" : False, "namedtuple_as_object" : False,
+                   "allow_nan" : True, "ignore_nan" : False,
+                   "bigint_as_string" : False, "iterable_as_array" : False}
+    elif name == "json":
+        module = json
+        options = {}
+    else:
+        raise ValueError("unknown json backend: %s" % name)
+
+    _encoder = module.JSONEncoder(default=_default, **options)
+    _sorted_encoder = module.JSONEncoder(default=_default, sort_keys=True, **options)
+    # simplejson decodes ascii strings to str instead of unicode, so
+    # parsing always goes through json's (also C) scanner
+    _decoder = json.JSONDecoder(object_hook=json_util.object_hook)
+    backend = name
+
+def dumps(obj, sort_keys = False):
+    start = time.time()
+    try:
+        if sort_keys:
+            return _sorted_encoder.encode(obj)
+        return _encoder.encode(obj)
+    finally:
+        timing.seconds = getattr(timing, "seconds", 0.0) + time.time() - start
+
+def loads(str):
+    return _decoder.decode(str)
+
+
+if simplejson != None:
+    use("simplejson")
+else:
+    use("json")
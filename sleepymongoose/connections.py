@@ -0,0 +1,81 @@
+# Copyright 2009-2010 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+class MongoConnectionState:
+    """
+    how a named connection is doing.  once it fails, requests for it fail
+    right away and the health checker retries it, waiting twice as long
+    after each failure.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.up = True
+        self.failures = 0
+        self.retry_at = 0
+        self.last_check = time.time()
+        self.last_error = None
+
+    def failed(self, error, backoff, max_backoff):
+        self.up = False
+        self.failures = self.failures + 1
+        self.last_check = time.time()
+        self.retry_at = self.last_check + min(max_backoff, backoff * (2 ** (self.failures - 1)))
+        self.last_error = "%s" % error
+
+    def succeeded(self):
+        self.up = True
+        self.failures = 0
+        self.retry_at = 0
+        self.last_check = time.time()
+        self.last_error = None
+
+    def stats(self):
+        result = {"uri" : self.uri, "up" : self.up, "failures" : self.failures}
+        if not self.up:
+            result["last_error"] = self.last_error
+            result["retry_in"] = max(0, self.retry_at - time.time())
+        return result
+
+
+def pool_stats(conn):
+    """
+    how many sockets the driver's pool has in use and sitting idle.  this
+    digs into pymongo 2.x internals, so anything it can't find is left out.
+    """
+    result = {}
+
+    member = getattr(conn, "_MongoClient__member", None)
+    pool = getattr(member, "pool", None)
+    if pool == None:
+        return result
+
+    max_size = getattr(pool, "max_size", None)
+    if max_size != None:
+        result["max_size"] = max_size
+
+    sockets = getattr(pool, "sockets", None)
+    if sockets != None:
+        result["idle"] = len(sockets)
+
+    semaphore = getattr(pool, "_socket_semaphore", None)
+    # bounded by a wait queue, the real semaphore is wrapped
+    semaphore = getattr(semaphore, "semaphore", semaphore)
+    available = getattr(semaphore, "_value", None)
+    if available != None and max_size != None:
+        result["in_use"] = max_size - available
+
+    return result
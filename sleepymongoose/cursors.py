@@ -0,0 +1,172 @@
+# Copyright 2009-2010 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+
+import threading
+import time
+
+class MongoCursorRegistry:
+    """
+    the open cursors, by id.  a cursor is dropped (and closed on the server)
+    when it's been idle for more than timeout seconds, or when there are
+    more than max_cursors open, least recently used first.
+
+    the ids of the last max_exhausted cursors that ran out are remembered
+    for timeout seconds, so a _more after the last batch can still get an
+    empty one.
+    """
+
+    max_exhausted = 1000
+
+    def __init__(self, timeout = 600, max_cursors = 1000):
+        self.timeout = timeout
+        self.max_cursors = max_cursors
+
+        # least recently used first
+        self.cursors = OrderedDict()
+        # id -> when it ran out, oldest first
+        self.exhausted = OrderedDict()
+        self.lock = threading.Lock()
+        self.reaper = None
+
+    def __len__(self):
+        return len(self.cursors)
+
+    def add(self, id, cursor):
+        cursor.last_used = time.time()
+
+        evicted = []
+        self.lock.acquire()
+        try:
+            self.cursors[id] = cursor
+            while len(self.cursors) > self.max_cursors:
+                evicted.append(self.cursors.popitem(last = False)[1])
+        finally:
+            self.lock.release()
+
+        for old in evicted:
+            self._close(old)
+
+    def get(self, id):
+        self.lock.acquire()
+        try:
+            cursor = self.cursors.pop(id, None)
+            if cursor == None:
+                return None
+            self.cursors[id] = cursor
+        finally:
+            self.lock.release()
+
+        cursor.last_used = time.time()
+        return cursor
+
+    def remove(self, id):
+        """
+        forget about a cursor and close it, returns if it was open
+        """
+        self.lock.acquire()
+        try:
+            cursor = self.cursors.pop(id, None)
+        finally:
+            self.lock.release()
+
+        if cursor == None:
+            return False
+
+        self._close(cursor)
+        return True
+
+    def exhaust(self, id):
+        """
+        forget about a cursor that ran out, remembering that it did
+        """
+        self.remove(id)
+
+        self.lock.acquire()
+        try:
+            self.exhausted[id] = time.time()
+            while len(self.exhausted) > self.max_exhausted:
+                self.exhausted.popitem(last = False)
+        finally:
+            self.lock.release()
+
+    def is_exhausted(self, id):
+        self.lock.acquire()
+        try:
+            when = self.exhausted.get(id)
+            return when != None and when >= time.time() - self.timeout
+        finally:
+            self.lock.release()
+
+    def reap(self):
+        """
+        close every cursor that's been idle for too long
+        """
+        cutoff = time.time() - self.timeout
+
+        expired = []
+        self.lock.acquire()
+        try:
+            for (id, cursor) in self.cursors.items():
+                if cursor.last_used >= cutoff:
+                    break
+                expired.append(id)
+        finally:
+            self.lock.release()
+
+        count = 0
+        for id in expired:
+            cursor = self.cursors.get(id)
+            # it might have been used again since we looked
+            if cursor != None and cursor.last_used < cutoff and self.remove(id):
+                count = count + 1
+
+        return count
+
+    def start_reaper(self, interval = None):
+        if self.reaper != None:
+            return
+
+        if interval == None:
+            interval = max(1, min(60, self.timeout / 2))
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reap()
+                except Exception, e:
+                    print "error reaping cursors: %s" % e
+
+        self.reaper = threading.Thread(target = run, name = "cursor-reaper")
+        self.reaper.setDaemon(True)
+        self.reaper.start()
+
+    def _close(self, cursor):
+        # wait for anyone still reading from it
+        cursor.lock.acquire()
+        try:
+            try:
+                cursor.close()
+            except Exception:
+                # the server will time it out on its own
+                pass
+
+            # let whoever opened it clean up after it
+            on_close = getattr(cursor, "on_close", None)
+            if on_close != None:
+                on_close(cursor)
+        finally:
+            cursor.lock.release()
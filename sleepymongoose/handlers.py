@@ -14,22 +14,143 @@
 
 from bson.son import SON
 from pymongo import Connection, ASCENDING, DESCENDING
-from pymongo.errors import ConnectionFailure, ConfigurationError, OperationFailure, AutoReconnect
-from bson import json_util
+from pymongo.errors import ConnectionFailure, ConfigurationError, OperationFailure, AutoReconnect, BulkWriteError
+from bson import json_util, BSON
+from bson.objectid import ObjectId
+from bson.errors import InvalidBSON
+from cursors import MongoCursorRegistry
+from cache import MongoQueryCache, MongoPlanCache
+from connections import MongoConnectionState, pool_stats
+from pool import WorkerPool
+from metrics import MongoMetrics
+from coalesce import MongoInsertCoalescer
+import codec
 
 import re
-try:
-    import json
-except ImportError:
-    import simplejson as json
+import threading
+import collections
+import time
+import struct
+import base64
 
 class MongoHandler:
     mh = None
 
+    # settings for each named connection, timeouts are in seconds
+    connection_class = Connection
+    pool_size = 100
+    socket_timeout = 2
+    connect_timeout = 2
+    wait_queue_timeout = None
+    wait_queue_multiple = None
+
+    # seconds between pings of each connection, 0 turns health checks off
+    health_interval = 10
+    # seconds before a dead connection is retried, doubling with each
+    # failure up to max_retry_backoff
+    retry_backoff = 1
+    max_retry_backoff = 60
+
     _cursor_id = 0
+    _cursor_id_lock = threading.Lock()
+
+    # with prefork workers, cursor ids are numbered so that id % workers is
+    # the worker that owns the cursor
+    workers = 0
+    worker = 0
+
+    # seconds a cursor can sit unused before it's closed
+    cursor_timeout = 600
+    # how many cursors can be open at once, the least recently used one is
+    # closed to make room
+    max_cursors = 1000
+
+    # seconds a _find result is cached for, 0 turns the cache off
+    cache_ttl = 0
+    # most bytes of encoded results to cache
+    cache_size = 64 * 1024 * 1024
+
+    # parsed uris and _find arguments to keep, each
+    plan_cache_size = 1000
+
+    # seconds a _tail waits for new documents by default and at most, and
+    # how long it waits before reopening a tailable cursor that died.  a
+    # server without a thread to spare sets max_tail_timeout to 0, so a
+    # _tail there only returns what's already been added.
+    tail_timeout = 30
+    max_tail_timeout = 300
+    tail_retry = 0.5
+    # most _tails waiting at once, each holds a thread.  0 is no limit,
+    # None is half the threads serving requests, so the rest are left for
+    # everything else.
+    max_tails = None
+
+    # a streamed _insert is sent to the db whenever this many documents, or
+    # this many bytes of them, have been read
+    insert_chunk_docs = 1000
+    insert_chunk_bytes = 4 * 1024 * 1024
+
+    # small form _inserts into the same collection are held for this many
+    # seconds, or until there are coalesce_docs of them, and sent together.
+    # 0 turns that off.
+    coalesce_window = 0
+    coalesce_docs = 100
+    coalesce_threads = 4
+
+    # most sub-requests of a parallel _batch that run at once
+    batch_concurrency = 8
+    _batch_local = threading.local()
+
+    # read the next batch of an open cursor ahead of time, on this many
+    # threads, holding at most this many encoded bytes per cursor and in all
+    prefetch = False
+    prefetch_threads = 4
+    prefetch_cursor_bytes = 1024 * 1024
+    prefetch_bytes = 64 * 1024 * 1024
+
+    # the operations a uri can call
+    operations = ["_cmd", "_hello", "_status", "_metrics", "_connect",
+                  "_authenticate", "_find", "_more", "_tail", "_killcursors",
+                  "_insert", "_update", "_remove", "_bulk", "_batch"]
+
+    # operations that can answer in raw bson
+    bson_ops = ["_find", "_more"]
 
     def __init__(self, mongos):
         self.connections = {}
+        self.health = {}
+        self.batch_pool = None
+        self.cursors = MongoCursorRegistry(MongoHandler.cursor_timeout, MongoHandler.max_cursors)
+        self.cursors.start_reaper()
+        self.lock = threading.Lock()
+        self.metrics = MongoMetrics()
+
+        self.insert_coalescer = None
+        if MongoHandler.coalesce_window > 0:
+            self.insert_coalescer = MongoInsertCoalescer(self.__flush_inserts,
+                MongoHandler.coalesce_window, MongoHandler.coalesce_docs,
+                MongoHandler.coalesce_threads)
+
+        self.tails = 0
+
+        self.prefetch_pool = None
+        self.prefetch_size = 0
+        self.prefetch_lock = threading.Lock()
+        if MongoHandler.prefetch:
+            self.prefetch_pool = WorkerPool(MongoHandler.prefetch_threads, "prefetch")
+
+        self.query_cache = None
+        if MongoHandler.cache_ttl > 0:
+            self.query_cache = MongoQueryCache(MongoHandler.cache_ttl, MongoHandler.cache_size)
+
+        self.ops = self._dispatch_table()
+        self.call_plans = MongoPlanCache(MongoHandler.plan_cache_size)
+        self.find_plans = MongoPlanCache(MongoHandler.plan_cache_size)
+
+        if MongoHandler.health_interval > 0:
+            checker = threading.Thread(target = self.__check_connections, name = "health-check")
+            checker.setDaemon(True)
+            checker.start()
 
         for host in mongos:
             args = MongoFakeFieldStorage({"server" : host})
@@ -43,20 +164,108 @@ class MongoHandler:
 
             self._connect(args, out.ostream, name = name)
         
-    def _get_connection(self, name = None, uri='mongodb://localhost:27017'):
+    def _get_connection(self, name = None, uri = None):
         if name == None:
             name = "default"
 
-        if name in self.connections:
-            return self.connections[name]
-        
-        try:
-            connection = Connection(uri, network_timeout = 2)
-        except (ConnectionFailure, ConfigurationError):
+        # a dead connection fails fast while the health checker retries it,
+        # unless we're being pointed somewhere else
+        state = self.health.get(name)
+        if state != None and not state.up and (uri == None or uri == state.uri):
             return None
 
-        self.connections[name] = connection
-        return connection
+        connection = self.connections.get(name)
+        if connection != None:
+            return connection
+
+        if uri == None:
+            uri = 'mongodb://localhost:27017'
+
+        # only one thread gets to connect a given name, the rest wait for it
+        self.lock.acquire()
+        try:
+            if name in self.connections:
+                return self.connections[name]
+
+            state = MongoConnectionState(uri)
+            self.health[name] = state
+
+            try:
+                connection = self._new_connection(uri)
+            except (ConnectionFailure, ConfigurationError), e:
+                state.failed(e, MongoHandler.retry_backoff, MongoHandler.max_retry_backoff)
+                return None
+
+            self.connections[name] = connection
+            return connection
+        finally:
+            self.lock.release()
+
+    def _new_connection(self, uri):
+        options = {"max_pool_size" : MongoHandler.pool_size,
+                   "socketTimeoutMS" : int(MongoHandler.socket_timeout * 1000),
+                   "connectTimeoutMS" : int(MongoHandler.connect_timeout * 1000)}
+        if MongoHandler.wait_queue_timeout != None:
+            options["waitQueueTimeoutMS"] = int(MongoHandler.wait_queue_timeout * 1000)
+        if MongoHandler.wait_queue_multiple != None:
+            options["waitQueueMultiple"] = MongoHandler.wait_queue_multiple
+
+        return MongoHandler.connection_class(uri, **options)
+
+    def __check_connections(self):
+        """
+        ping live connections every health_interval seconds and retry dead
+        ones when their backoff is up
+        """
+        while True:
+            time.sleep(1)
+
+            now = time.time()
+            for (name, state) in self.health.items():
+                if state.up and now - state.last_check < MongoHandler.health_interval:
+                    continue
+                if not state.up and now < state.retry_at:
+                    continue
+
+                try:
+                    connection = self.connections.get(name)
+                    if connection == None:
+                        connection = self._new_connection(state.uri)
+                    connection.admin.command("ping")
+                except Exception, e:
+                    state.failed(e, MongoHandler.retry_backoff, MongoHandler.max_retry_backoff)
+                    continue
+
+                self.connections[name] = connection
+                state.succeeded()
+
+    def _dispatch_table(self):
+        """
+        the operations a uri can call, by name
+        """
+        ops = {}
+        for name in MongoHandler.operations:
+            ops[name] = getattr(self, name)
+        return ops
+
+    def _next_cursor_id(self):
+        MongoHandler._cursor_id_lock.acquire()
+        try:
+            id = MongoHandler._cursor_id
+            MongoHandler._cursor_id = MongoHandler._cursor_id + 1
+            if MongoHandler.workers > 0:
+                id = id * MongoHandler.workers + MongoHandler.worker
+            return id
+        finally:
+            MongoHandler._cursor_id_lock.release()
+
+    def _cursor_worker(self, id):
+        """
+        the prefork worker that owns cursor id, or None if there are no workers
+        """
+        if MongoHandler.workers > 0:
+            return id % MongoHandler.workers
+        return None
 
     def _get_host_and_port(self, server):
         host = "localhost"
@@ -90,7 +299,7 @@ class MongoHandler:
 
     def _get_son(self, str, out):
         try:
-            obj = json.loads(str, object_hook=json_util.object_hook)
+            obj = codec.loads(str)
         except (ValueError, TypeError):
             out('{"ok" : 0, "errmsg" : "couldn\'t parse json: %s"}' % str)
             return None
@@ -125,11 +334,18 @@ class MongoHandler:
             out('{"ok" : 0, "errmsg" : "%s"}' % error)
             return
 
+        # commands can touch any collection, and some of them (like
+        # renameCollection) other dbs, so be conservative
+        if db == "admin":
+            self.__invalidate(name)
+        else:
+            self.__invalidate(name, db)
+
         # debugging
         if result['ok'] == 0:
             result['cmd'] = args.getvalue('cmd')
 
-        out(json.dumps(result, default=json_util.default))
+        out(codec.dumps(result))
         
     def _hello(self, args, out, name = None, db = None, collection = None):
         out('{"ok" : 1, "msg" : "Uh, we had a slight weapons malfunction, but ' + 
@@ -138,12 +354,39 @@ class MongoHandler:
         return
         
     def _status(self, args, out, name = None, db = None, collection = None):
-        result = {"ok" : 1, "connections" : {}}
+        result = {"ok" : 1, "connections" : {}, "cursors" : len(self.cursors), "json" : codec.backend}
 
-        for name, conn in self.connections.iteritems():
+        for name, conn in self.connections.items():
             result['connections'][name] = "%s:%d" % (conn.host, conn.port)
 
-        out(json.dumps(result))
+        result['pools'] = {}
+        for name, state in self.health.items():
+            pool = state.stats()
+            if name in self.connections:
+                pool.update(pool_stats(self.connections[name]))
+            result['pools'][name] = pool
+
+        if self.query_cache != None:
+            result['cache'] = self.query_cache.stats()
+
+        result['plans'] = {"calls" : self.call_plans.stats(), "finds" : self.find_plans.stats()}
+
+        if self.prefetch_pool != None:
+            result['prefetch'] = {"bytes" : self.prefetch_size}
+
+        if MongoHandler.workers > 0:
+            result['worker'] = MongoHandler.worker
+
+        out(codec.dumps(result))
+
+    def _metrics(self, args, out, name = None, db = None, collection = None):
+        """
+        request metrics, in prometheus' text format
+        """
+        if hasattr(out, "set_content_type"):
+            out.set_content_type("text/plain")
+
+        out(self.metrics.render(len(self.cursors)))
     
     def _connect(self, args, out, name = None, db = None, collection = None):
         """
@@ -212,6 +455,13 @@ class MongoHandler:
             out('{"ok" : 0, "errmsg" : "_find must be a GET request"}')
             return
 
+        format = self.__get_format(args, out)
+        if format == None:
+            return
+        if format == "bson":
+            raw_out = out
+            out = self.__bson_out(raw_out)
+
         conn = self._get_connection(name)
         if conn == None:
             out('{"ok" : 0, "errmsg" : "couldn\'t get connection to mongo"}')
@@ -221,17 +471,10 @@ class MongoHandler:
             out('{"ok" : 0, "errmsg" : "db and collection must be defined"}')
             return            
 
-        criteria = {}
-        if 'criteria' in args:
-            criteria = self._get_son(args['criteria'][0], out)
-            if criteria == None:
-                return
-
-        fields = None
-        if 'fields' in args:
-            fields = self._get_son(args['fields'][0], out)
-            if fields == None:
-                return
+        plan = self.__find_plan(args, out)
+        if plan == None:
+            return
+        (criteria, fields, sort, stupid_sort, normalized) = plan
 
         limit = 0
         if 'limit' in args:
@@ -241,43 +484,128 @@ class MongoHandler:
         if 'skip' in args:
             skip = int(args['skip'][0])
 
+        batch_size = 15
+        if 'batch_size' in args:
+            batch_size = int(args['batch_size'][0])
+
+        explain = 'explain' in args and bool(args['explain'][0])
+
+        if 'after' in args or ('keyset' in args and bool(args['keyset'][0])):
+            if explain or limit != 0 or skip != 0:
+                out('{"ok" : 0, "errmsg" : "keyset pages can\'t be combined with limit, skip or explain"}')
+                return
+            if batch_size < 1:
+                out('{"ok" : 0, "errmsg" : "keyset pages need a batch_size of at least 1"}')
+                return
+            if format == "bson":
+                out = raw_out
+            self.__find_keyset(args, out, conn[db][collection], criteria, fields, sort,
+                               batch_size, format)
+            return
+
+        cache = self.query_cache
+        if format == "bson":
+            cache = None
+        if cache != None and not explain:
+            key = codec.dumps([name or "default", db, collection, limit, skip]) + normalized
+            docs = cache.get(key)
+            # a hit is only good if it all fits in the batch asked for
+            if docs != None and len(docs) <= batch_size:
+                id = self._next_cursor_id()
+                # there's no cursor behind it, but a _more should still work
+                self.cursors.exhaust(id)
+                out('{"results" : [%s], "id" : %d, "ok" : 1}' % (", ".join(docs), id))
+                return
+            generation = cache.generation
+
         cursor = conn[db][collection].find(spec=criteria, fields=fields, limit=limit, skip=skip)
 
+        if stupid_sort != None:
+            cursor.sort(stupid_sort)
+
+        if explain:
+            out(codec.dumps({"results" : [cursor.explain()], "ok" : 1}))
+
+
+        id = self._next_cursor_id()
+        setattr(cursor, "id", id)
+        setattr(cursor, "lock", threading.Lock())
+        if self.prefetch_pool != None:
+            setattr(cursor, "prefetched", collections.deque())
+            setattr(cursor, "prefetched_bytes", 0)
+            setattr(cursor, "prefetch_end", None)
+            setattr(cursor, "prefetch_pending", False)
+            setattr(cursor, "on_close", self.__drop_prefetched)
+        self.cursors.add(id, cursor)
+
+        if format == "bson":
+            self.__output_bson(cursor, raw_out, batch_size)
+            return
+
+        if cache == None or explain:
+            self.__output_results(cursor, out, batch_size)
+            return
+
+        docs = []
+        if self.__output_results(cursor, out, batch_size, docs):
+            cache.put(key, (name or "default", db, collection), docs, generation)
+
+
+    def __find_plan(self, args, out):
+        """
+        a _find's criteria, fields and sort, the sort as pymongo wants it and
+        the three normalized for the query cache's key.  the same queries
+        keep coming in, so this is cached by the arguments' json.
+        """
+        raw = (args.get('criteria', [None])[0], args.get('fields', [None])[0],
+               args.get('sort', [None])[0])
+
+        # _batch can hand over anything, and only strings make a key
+        cacheable = True
+        for value in raw:
+            if value != None and not isinstance(value, basestring):
+                cacheable = False
+
+        plan = None
+        if cacheable:
+            plan = self.find_plans.get(raw)
+        if plan != None:
+            return plan
+
+        criteria = {}
+        if raw[0] != None:
+            criteria = self._get_son(raw[0], out)
+            if criteria == None:
+                return None
+
+        fields = None
+        if raw[1] != None:
+            fields = self._get_son(raw[1], out)
+            if fields == None:
+                return None
+
         sort = None
-        if 'sort' in args:
-            sort = self._get_son(args['sort'][0], out)
+        stupid_sort = None
+        if raw[2] != None:
+            sort = self._get_son(raw[2], out)
             if sort == None:
-                return
+                return None
 
             stupid_sort = []
-
             for field in sort:
                 if sort[field] == -1:
                     stupid_sort.append([field, DESCENDING])
                 else:
                     stupid_sort.append([field, ASCENDING])
 
-            cursor.sort(stupid_sort)
-
-        if 'explain' in args and bool(args['explain'][0]):
-            out(json.dumps({"results" : [cursor.explain()], "ok" : 1}, default=json_util.default))
-
-
-        if not hasattr(self, "cursors"):
-            setattr(self, "cursors", {})
-
-        id = MongoHandler._cursor_id
-        MongoHandler._cursor_id = MongoHandler._cursor_id + 1
+        normalized = None
+        if self.query_cache != None:
+            normalized = codec.dumps([criteria, fields, sort], sort_keys=True)
 
-        cursors = getattr(self, "cursors")
-        cursors[id] = cursor
-        setattr(cursor, "id", id)
-
-        batch_size = 15
-        if 'batch_size' in args:
-            batch_size = int(args['batch_size'][0])
-            
-        self.__output_results(cursor, out, batch_size)
+        plan = (criteria, fields, sort, stupid_sort, normalized)
+        if cacheable:
+            self.find_plans.put(raw, plan)
+        return plan
 
 
     def _more(self, args, out, name = None, db = None, collection = None):
@@ -289,47 +617,624 @@ class MongoHandler:
             out('{"ok" : 0, "errmsg" : "_more must be a GET request"}')
             return
 
+        format = self.__get_format(args, out)
+        if format == None:
+            return
+        if format == "bson":
+            raw_out = out
+            out = self.__bson_out(raw_out)
+
         if 'id' not in args:
             out('{"ok" : 0, "errmsg" : "no cursor id given"}')
             return
 
 
         id = int(args["id"][0])
-        cursors = getattr(self, "cursors")
 
-        if id not in cursors:
-            out('{"ok" : 0, "errmsg" : "couldn\'t find the cursor with id %d"}' % id)
+        cursor = self.cursors.get(id)
+        if cursor == None and self.cursors.is_exhausted(id):
+            # it's already sent everything
+            if format == "bson":
+                self.__start_bson(raw_out, id)
+                raw_out(BSON.encode(SON([("ok", 1), ("id", id), ("ndocs", 0)])))
+            else:
+                out('{"results" : [], "id" : %d, "ok" : 1}' % id)
             return
 
-        cursor = cursors[id]
+        if cursor == None:
+            owner = self._cursor_worker(id)
+            if owner != None and owner != MongoHandler.worker:
+                # the connection landed on a different process than the
+                # _find did, the client has to come back on that one
+                out('{"ok" : 0, "errmsg" : "cursor %d belongs to worker %d, this is worker %d", "worker" : %d}' %
+                    (id, owner, MongoHandler.worker, owner))
+                return
+            out('{"ok" : 0, "errmsg" : "couldn\'t find the cursor with id %d"}' % id)
+            return
 
         batch_size = 15
         if 'batch_size' in args:
             batch_size = int(args['batch_size'][0])
 
-        self.__output_results(cursor, out, batch_size)
+        if format == "bson":
+            self.__output_bson(cursor, raw_out, batch_size)
+        else:
+            self.__output_results(cursor, out, batch_size)
+
+
+    def _tail(self, args, out, name = None, db = None, collection = None):
+        """
+        Wait for documents to be added to a capped collection.  Answers as
+        soon as there are some, or with none after timeout seconds, either
+        way with a next token to pass back as after.  Without after, only
+        documents added from now on are returned.
+        """
+
+        if type(args).__name__ != 'dict':
+            out('{"ok" : 0, "errmsg" : "_tail must be a GET request"}')
+            return
+
+        conn = self._get_connection(name)
+        if conn == None:
+            out('{"ok" : 0, "errmsg" : "couldn\'t get connection to mongo"}')
+            return
+
+        if db == None or collection == None:
+            out('{"ok" : 0, "errmsg" : "db and collection must be defined"}')
+            return
+
+        criteria = {}
+        if 'criteria' in args:
+            criteria = self._get_son(args['criteria'][0], out)
+            if criteria == None:
+                return
+
+        timeout = MongoHandler.tail_timeout
+        batch_size = 100
+        try:
+            if 'timeout' in args:
+                timeout = max(0, float(args['timeout'][0]))
+            if 'batch_size' in args:
+                batch_size = max(1, int(args['batch_size'][0]))
+        except (ValueError, TypeError):
+            out('{"ok" : 0, "errmsg" : "timeout and batch_size must be numbers"}')
+            return
+        timeout = min(timeout, MongoHandler.max_tail_timeout)
+
+        coll = conn[db][collection]
+        query = [name or "default", db, collection, criteria]
+
+        # the token says which cursor to keep reading from and, in case it's
+        # gone, the last _id that was sent
+        if 'after' in args:
+            try:
+                (cursor_id, last_id) = codec.loads(base64.urlsafe_b64decode(str(args['after'][0])))
+            except (ValueError, TypeError):
+                out('{"ok" : 0, "errmsg" : "invalid after token"}')
+                return
+        else:
+            cursor_id = None
+            try:
+                last_id = self.__tail_start(coll, criteria)
+            except AutoReconnect:
+                out('{"ok" : 0, "errmsg" : "auto reconnecting, please try again"}')
+                return
+            except OperationFailure, of:
+                out(codec.dumps({"ok" : 0, "errmsg" : "%s" % of}))
+                return
+
+        self.lock.acquire()
+        try:
+            if MongoHandler.max_tails and self.tails >= MongoHandler.max_tails:
+                out('{"ok" : 0, "errmsg" : "too many _tails waiting, please try again"}')
+                return
+            self.tails = self.tails + 1
+        finally:
+            self.lock.release()
+
+        try:
+            (docs, cursor, last_id, errmsg) = self.__tail_wait(coll, query, cursor_id, last_id,
+                                                              time.time() + timeout, batch_size)
+        finally:
+            self.lock.acquire()
+            self.tails = self.tails - 1
+            self.lock.release()
+
+        cursor_id = None
+        if cursor != None:
+            cursor_id = cursor.id
+        next = base64.urlsafe_b64encode(codec.dumps([cursor_id, last_id]))
+
+        if errmsg != None:
+            # send what did arrive, so it's not lost
+            out(codec.dumps({"results" : docs, "next" : next, "ok" : 0, "errmsg" : errmsg}))
+            return
+
+        out(codec.dumps({"results" : docs, "next" : next, "ok" : 1}))
+
+
+    def __tail_start(self, coll, criteria):
+        """
+        the _id of the newest document, so a new _tail starts after it
+        """
+        cursor = coll.find(spec=criteria, fields={"_id" : 1}, limit=1)
+        cursor.sort("$natural", DESCENDING)
+        try:
+            for doc in cursor:
+                return doc.get("_id")
+        finally:
+            cursor.close()
+        return None
+
+
+    def __tail_wait(self, coll, query, cursor_id, last_id, deadline, batch_size):
+        """
+        read from the _tail's cursor until there's something to send or the
+        deadline passes.  returns the documents, the cursor if it's still
+        open, the last _id read and an errmsg.
+        """
+        cursor = None
+        if cursor_id != None:
+            cursor = self.cursors.get(cursor_id)
+            # ids are reused after a restart, and tokens can be made up
+            if cursor != None and getattr(cursor, "tail", None) != query:
+                cursor = None
+
+        docs = []
+        errmsg = None
+        while True:
+            if cursor == None:
+                cursor = self.__tail_open(coll, query, last_id)
+
+            cursor.lock.acquire()
+            try:
+                while len(docs) < batch_size:
+                    doc = cursor.next()
+                    if cursor.skip_to != None:
+                        # already sent, up to and including skip_to
+                        if doc.get("_id") == cursor.skip_to:
+                            cursor.skip_to = None
+                        continue
+                    docs.append(doc)
+                    last_id = doc.get("_id", last_id)
+                    # don't wait on the server for more once there's
+                    # something to send
+                    if not self.__tail_buffered(cursor):
+                        break
+            except StopIteration:
+                # nothing new within the server's await time
+                pass
+            except AutoReconnect:
+                errmsg = "auto reconnecting, please try again"
+            except OperationFailure, of:
+                errmsg = "%s" % of
+            finally:
+                cursor.lock.release()
+
+            if not cursor.alive or errmsg != None:
+                self.cursors.remove(cursor.id)
+                cursor = None
+
+            if len(docs) > 0 or errmsg != None or time.time() >= deadline:
+                return (docs, cursor, last_id, errmsg)
+
+            if cursor == None:
+                # a tailable cursor on an empty collection dies right away
+                time.sleep(max(0, min(MongoHandler.tail_retry, deadline - time.time())))
+
+
+    def __tail_open(self, coll, query, last_id):
+        """
+        open a tailable cursor that picks up after last_id.  _ids don't have
+        to increase, so it reads in insertion order and skips what comes up
+        to last_id.  if last_id has already been pushed out of the capped
+        collection, everything left is newer and is sent from the start,
+        though whatever went out with it is lost.
+        """
+        criteria = query[3]
+
+        skip_to = None
+        if last_id != None:
+            spec = {"_id" : last_id}
+            if len(criteria) > 0:
+                spec = {"$and" : [criteria, spec]}
+            if coll.find_one(spec, fields={"_id" : 1}) != None:
+                skip_to = last_id
+
+        cursor = coll.find(spec=criteria, tailable=True,
+                           await_data=MongoHandler.max_tail_timeout > 0)
+        cursor.sort("$natural", ASCENDING)
+
+        id = self._next_cursor_id()
+        setattr(cursor, "id", id)
+        setattr(cursor, "skip_to", skip_to)
+        setattr(cursor, "lock", threading.Lock())
+        setattr(cursor, "tail", query)
+        self.cursors.add(id, cursor)
+        return cursor
+
+
+    def __tail_buffered(self, cursor):
+        # pymongo doesn't say whether next() will have to go to the server,
+        # but the batch it's reading from is in its private __data deque
+        data = getattr(cursor, "_Cursor__data", None)
+        return data != None and len(data) > 0
+
+
+    def _killcursors(self, args, out, name = None, db = None, collection = None):
+        """
+        Close cursors that won't be read from again
+        """
+
+        if type(args).__name__ == 'dict':
+            out('{"ok" : 0, "errmsg" : "_killcursors must be a POST request"}')
+            return
+
+        if "ids" not in args:
+            out('{"ok" : 0, "errmsg" : "missing ids"}')
+            return
+
+        ids = self._get_son(args.getvalue('ids'), out)
+        if ids == None:
+            return
+
+        killed = 0
+        for id in ids:
+            if self.cursors.remove(int(id)):
+                killed = killed + 1
 
+        out('{"ok" : 1, "killed" : %d}' % killed)
 
-    def __output_results(self, cursor, out, batch_size=15):
+
+    def __find_keyset(self, args, out, coll, criteria, fields, sort, batch_size, format):
         """
-        Iterate through the next batch
+        a page of results that starts after the document an "after" token
+        points to.  pages are found with a range query on the sort keys
+        (and _id, to break ties), so no cursor is kept between them and a
+        deep page costs the same as the first one.
         """
-        batch = []
+        error = out
+        if format == "bson":
+            error = self.__bson_out(out)
+
+        keys = []
+        for field in (sort or {}):
+            if sort[field] == -1:
+                keys.append([field, DESCENDING])
+            else:
+                keys.append([field, ASCENDING])
+        if "_id" not in (sort or {}):
+            keys.append(["_id", ASCENDING])
+
+        spec = criteria
+        if 'after' in args:
+            try:
+                (token_keys, values) = codec.loads(base64.urlsafe_b64decode(str(args['after'][0])))
+            except (ValueError, TypeError):
+                error('{"ok" : 0, "errmsg" : "invalid after token"}')
+                return
+
+            if token_keys != keys or len(values) != len(keys):
+                error('{"ok" : 0, "errmsg" : "the after token is for a different sort"}')
+                return
 
+            spec = self.__keyset_range(keys, values)
+            if len(criteria) > 0:
+                spec = {"$and" : [criteria, spec]}
+
+        # the sort keys have to come back to make the next token from.
+        # fields may be shared with other requests, so it's copied
+        if fields != None:
+            if isinstance(fields, list):
+                fields = dict((field, 1) for field in fields)
+            else:
+                fields = dict(fields)
+            if len([v for v in fields.values() if v]) > 0:
+                for (field, direction) in keys:
+                    fields[field] = 1
+            else:
+                for (field, direction) in keys:
+                    if field in fields:
+                        error('{"ok" : 0, "errmsg" : "can\'t exclude sort key %s from keyset pages"}' % field)
+                        return
+
+        # one more than a page, to know if there's another one
+        cursor = coll.find(spec=spec, fields=fields, limit=batch_size + 1)
+        cursor.sort(keys)
+
+        docs = []
+        errmsg = None
         try:
-            while len(batch) < batch_size:
-                batch.append(cursor.next())
-        except AutoReconnect:
-            out(json.dumps({"ok" : 0, "errmsg" : "auto reconnecting, please try again"}))
+            try:
+                for doc in cursor:
+                    docs.append(doc)
+            except AutoReconnect:
+                errmsg = "auto reconnecting, please try again"
+            except OperationFailure, of:
+                errmsg = "%s" % of
+        finally:
+            cursor.close()
+
+        next = None
+        if len(docs) > batch_size:
+            docs = docs[:batch_size]
+            values = [self.__keyset_value(docs[-1], field) for (field, direction) in keys]
+            next = base64.urlsafe_b64encode(codec.dumps([keys, values]))
+
+        if errmsg != None:
+            error(codec.dumps({"ok" : 0, "errmsg" : errmsg}))
             return
-        except OperationFailure, of:
-            out(json.dumps({"ok" : 0, "errmsg" : "%s" % of}))
+
+        if format == "bson":
+            self.__start_bson(out)
+            out(BSON.encode(SON([("ok", 1), ("next", next), ("ndocs", len(docs))])))
+            for doc in docs:
+                out(BSON.encode(doc))
             return
+
+        out('{"results" : [')
+        for i in range(len(docs)):
+            if i > 0:
+                out(', ')
+            out(codec.dumps(docs[i]))
+        out('], "next" : %s, "ok" : 1}' % codec.dumps(next))
+
+
+    def __keyset_range(self, keys, values):
+        """
+        everything after values in keys order: greater on the first key, or
+        equal on it and greater on the second, and so on
+        """
+        clauses = []
+        for i in range(len(keys)):
+            clause = SON()
+            for j in range(i):
+                clause[keys[j][0]] = values[j]
+
+            (field, direction) = keys[i]
+            if direction == DESCENDING:
+                clause[field] = {"$lt" : values[i]}
+            elif values[i] == None:
+                # null sorts first, so everything that isn't null is after it
+                clause[field] = {"$ne" : None}
+            else:
+                clause[field] = {"$gt" : values[i]}
+            clauses.append(clause)
+
+        return {"$or" : clauses}
+
+
+    def __keyset_value(self, doc, field):
+        for part in field.split("."):
+            if not isinstance(doc, dict):
+                return None
+            doc = doc.get(part)
+        return doc
+
+
+    def __output_results(self, cursor, out, batch_size=15, capture=None):
+        """
+        Iterate through the next batch, writing out each document as soon as
+        the cursor returns it.  Encoded documents are also appended to
+        capture, if given.  Returns whether the whole result set was sent.
+        """
+        count = 0
+        errmsg = None
+        exhausted = False
+
+        # pymongo cursors aren't thread safe, so two _mores on the same id
+        # take turns
+        cursor.lock.acquire()
+        try:
+            while count < batch_size:
+                encoded = self.__next_encoded(cursor, "json")
+
+                if count == 0:
+                    out('{"results" : [')
+                else:
+                    out(', ')
+
+                if capture != None:
+                    capture.append(encoded)
+                out(encoded)
+
+                count = count + 1
+        except AutoReconnect:
+            errmsg = "auto reconnecting, please try again"
+        except OperationFailure, of:
+            errmsg = "%s" % of
         except StopIteration:
             # this is so stupid, there's no has_next?
-            pass
-        
-        out(json.dumps({"results" : batch, "id" : cursor.id, "ok" : 1}, default=json_util.default))
+            exhausted = True
+        finally:
+            cursor.lock.release()
+
+        exhausted = exhausted or self.__cursor_done(cursor)
+        if exhausted:
+            self.cursors.exhaust(cursor.id)
+        elif errmsg == None:
+            self.__start_prefetch(cursor, batch_size, "json")
+
+        if count == 0:
+            if errmsg != None:
+                out(codec.dumps({"ok" : 0, "errmsg" : errmsg}))
+                return False
+            out('{"results" : [')
+
+        if errmsg != None:
+            # part of the batch has already gone out, so finish the document
+            # and flag it as failed
+            out('], "id" : %d, "ok" : 0, "errmsg" : %s}' % (cursor.id, codec.dumps(errmsg)))
+            return False
+
+        out('], "id" : %d, "ok" : 1}' % cursor.id)
+        return exhausted
+
+
+    def __output_bson(self, cursor, out, batch_size=15):
+        """
+        Send the next batch as raw bson: an {"ok", "id", "ndocs"} envelope
+        document followed by ndocs documents, each starting with its length
+        """
+        docs = []
+        errmsg = None
+        exhausted = False
+
+        cursor.lock.acquire()
+        try:
+            while len(docs) < batch_size:
+                docs.append(self.__next_encoded(cursor, "bson"))
+        except AutoReconnect:
+            errmsg = "auto reconnecting, please try again"
+        except OperationFailure, of:
+            errmsg = "%s" % of
+        except StopIteration:
+            exhausted = True
+        finally:
+            cursor.lock.release()
+
+        if exhausted or self.__cursor_done(cursor):
+            self.cursors.exhaust(cursor.id)
+        elif errmsg == None:
+            self.__start_prefetch(cursor, batch_size, "bson")
+
+        envelope = SON([("ok", 1), ("id", cursor.id), ("ndocs", len(docs))])
+        if errmsg != None:
+            envelope["ok"] = 0
+            envelope["errmsg"] = errmsg
+
+        self.__start_bson(out, cursor.id)
+        out(BSON.encode(envelope))
+        for doc in docs:
+            out(doc)
+
+
+    def __next_encoded(self, cursor, format):
+        """
+        the cursor's next document, encoded as format.  prefetched documents
+        come first.  call with the cursor's lock held.
+        """
+        prefetched = getattr(cursor, "prefetched", None)
+        if prefetched:
+            (encoded_as, encoded) = prefetched.popleft()
+            cursor.prefetched_bytes = cursor.prefetched_bytes - len(encoded)
+            self.__prefetch_account(-len(encoded))
+
+            if encoded_as == format:
+                return encoded
+            elif format == "json":
+                return codec.dumps(BSON(encoded).decode())
+            else:
+                return BSON.encode(codec.loads(encoded))
+
+        # whatever stopped the prefetch happens now
+        end = getattr(cursor, "prefetch_end", None)
+        if end != None:
+            cursor.prefetch_end = None
+            raise end
+
+        if format == "json":
+            return codec.dumps(cursor.next())
+        return BSON.encode(cursor.next())
+
+
+    def __cursor_done(self, cursor):
+        return not cursor.alive and not getattr(cursor, "prefetched", None)
+
+
+    def __start_prefetch(self, cursor, batch_size, format):
+        if self.prefetch_pool == None or cursor.prefetch_pending:
+            return
+
+        cursor.prefetch_pending = True
+        self.prefetch_pool.submit(self.__prefetch, cursor, batch_size, format)
+
+
+    def __prefetch(self, cursor, batch_size, format):
+        """
+        read up to a batch ahead, in the format the client last asked for,
+        while there's room in the budgets
+        """
+        cursor.lock.acquire()
+        try:
+            cursor.prefetch_pending = False
+            while (len(cursor.prefetched) < batch_size and cursor.prefetch_end == None and
+                   cursor.prefetched_bytes < MongoHandler.prefetch_cursor_bytes and
+                   self.prefetch_size < MongoHandler.prefetch_bytes):
+                try:
+                    doc = cursor.next()
+                except (StopIteration, AutoReconnect, OperationFailure), e:
+                    cursor.prefetch_end = e
+                    break
+
+                if format == "json":
+                    encoded = codec.dumps(doc)
+                else:
+                    encoded = BSON.encode(doc)
+
+                cursor.prefetched.append((format, encoded))
+                cursor.prefetched_bytes = cursor.prefetched_bytes + len(encoded)
+                self.__prefetch_account(len(encoded))
+        finally:
+            cursor.lock.release()
+
+
+    def __drop_prefetched(self, cursor):
+        # called by the cursor registry, with the cursor's lock held
+        self.__prefetch_account(-cursor.prefetched_bytes)
+        cursor.prefetched.clear()
+        cursor.prefetched_bytes = 0
+        cursor.prefetch_end = StopIteration()
+
+
+    def __prefetch_account(self, size):
+        self.prefetch_lock.acquire()
+        self.prefetch_size = self.prefetch_size + size
+        self.prefetch_lock.release()
+
+
+    def __get_format(self, args, out):
+        format = "json"
+        if 'format' in args:
+            format = args['format'][0]
+
+        if format not in ("json", "bson"):
+            out('{"ok" : 0, "errmsg" : "unknown format: %s"}' % format)
+            return None
+
+        return format
+
+
+    def __start_bson(self, out, cursor_id = None):
+        # only the top level response writer has headers to set
+        set_content_type = getattr(out, "set_content_type", None)
+        if set_content_type != None:
+            set_content_type("application/bson")
+            if cursor_id != None:
+                out.set_header("X-Cursor-Id", str(cursor_id))
+
+
+    def __bson_out(self, out):
+        """
+        wraps out so json responses are sent as bson envelopes instead
+        """
+        def write(content):
+            self.__start_bson(out)
+            out(self.__bson_envelope(content))
+        return write
+
+
+    def __bson_envelope(self, content):
+        try:
+            obj = codec.loads(content)
+        except (ValueError, TypeError):
+            obj = {"ok" : 0, "errmsg" : "couldn't convert the response to bson"}
+
+        if not isinstance(obj, dict):
+            obj = {"ok" : 1, "results" : obj}
+        obj["ndocs"] = 0
+
+        return BSON.encode(obj)
 
 
     def _insert(self, args, out, name = None, db = None, collection = None):
@@ -350,6 +1255,18 @@ class MongoHandler:
             out('{"ok" : 0, "errmsg" : "db and collection must be defined"}')
             return
 
+        content_type = getattr(args, "content_type", None)
+        if content_type == "application/x-ndjson":
+            self.__insert_chunked(args, out, conn[db][collection],
+                                  self.__read_ndjson(args.body), "line")
+            self.__invalidate(name, db, collection)
+            return
+        elif content_type == "application/bson":
+            self.__insert_chunked(args, out, conn[db][collection],
+                                  self.__read_bson(args.body, conn), "doc")
+            self.__invalidate(name, db, collection)
+            return
+
         if "docs" not in args: 
             out('{"ok" : 0, "errmsg" : "missing docs"}')
             return
@@ -362,12 +1279,248 @@ class MongoHandler:
         if "safe" in args:
             safe = bool(args.getvalue("safe"))
 
+        if self.insert_coalescer != None and self.__coalescible(docs):
+            self.__insert_coalesced(out, name, db, collection, docs, safe)
+            return
+
         result = {}
         result['oids'] = conn[db][collection].insert(docs)
+        self.__invalidate(name, db, collection)
         if safe:
             result['status'] = conn[db].last_status()
 
-        out(json.dumps(result, default=json_util.default))
+        out(codec.dumps(result))
+
+
+    def __coalescible(self, docs):
+        if isinstance(docs, dict):
+            return True
+        if not isinstance(docs, list) or len(docs) == 0 or len(docs) >= MongoHandler.coalesce_docs:
+            return False
+        for doc in docs:
+            if not isinstance(doc, dict):
+                return False
+        return True
+
+
+    def __insert_coalesced(self, out, name, db, collection, docs, safe):
+        """
+        hand docs to the coalescer.  they get their _ids here, so an unsafe
+        insert can answer with them without waiting for the write.  a safe
+        one waits and gets the errors for its own documents back.
+        """
+        single = isinstance(docs, dict)
+        if single:
+            docs = [docs]
+
+        for doc in docs:
+            if "_id" not in doc:
+                doc["_id"] = ObjectId()
+
+        result = {}
+        if single:
+            result['oids'] = docs[0]["_id"]
+        else:
+            result['oids'] = [doc["_id"] for doc in docs]
+
+        errors = self.insert_coalescer.insert((name, db, collection), docs, safe)
+        if safe:
+            status = {"ok" : 1, "n" : 0, "err" : None}
+            if len(errors) > 0:
+                status["err"] = errors[0]["errmsg"]
+                if "code" in errors[0]:
+                    status["code"] = errors[0]["code"]
+                status["writeErrors"] = errors
+            result['status'] = status
+
+        out(codec.dumps(result))
+
+
+    def __flush_inserts(self, key, docs):
+        """
+        called by the coalescer with everything it's gathered for a namespace
+        """
+        (name, db, collection) = key
+
+        conn = self._get_connection(name)
+        if conn == None:
+            return (0, [{"errmsg" : "couldn't get connection to mongo"}])
+
+        try:
+            return self.__insert_unordered(conn[db][collection], docs)
+        finally:
+            self.__invalidate(name, db, collection)
+
+
+    def __insert_chunked(self, args, out, coll, documents, position):
+        """
+        insert documents from the request body, sending them to the db in
+        unordered chunks as they're read.  documents yields (number, doc,
+        size, errmsg) tuples, position is what the numbers are called in
+        errors.
+        """
+        # documents doesn't read anything from the body until it's asked
+        # for the first one, so this can still turn the request down
+        chunk_docs = MongoHandler.insert_chunk_docs
+        chunk_bytes = MongoHandler.insert_chunk_bytes
+        try:
+            if "chunk_docs" in args:
+                chunk_docs = max(1, int(args.getvalue("chunk_docs")))
+            if "chunk_bytes" in args:
+                chunk_bytes = max(1, int(args.getvalue("chunk_bytes")))
+        except (ValueError, TypeError):
+            out('{"ok" : 0, "errmsg" : "chunk_docs and chunk_bytes must be numbers"}')
+            return
+
+        state = {"n" : 0, "errors" : 0, "first" : True}
+
+        def flush(docs, numbers, errors):
+            (n, write_errors) = self.__insert_unordered(coll, docs)
+            for error in write_errors:
+                if "index" in error:
+                    error[position] = numbers[error.pop("index")]
+                errors.append(error)
+
+            state["n"] = state["n"] + n
+            state["errors"] = state["errors"] + len(errors)
+
+            if state["first"]:
+                out('{"chunks" : [')
+                state["first"] = False
+            else:
+                out(', ')
+            out(codec.dumps({"n" : n, "errors" : errors}))
+
+        docs = []
+        numbers = []
+        errors = []
+        size = 0
+
+        for (number, doc, doc_size, errmsg) in documents:
+            if errmsg != None:
+                errors.append({position : number, "errmsg" : errmsg})
+                continue
+
+            docs.append(doc)
+            numbers.append(number)
+            size = size + doc_size
+
+            if len(docs) >= chunk_docs or size >= chunk_bytes:
+                flush(docs, numbers, errors)
+                docs = []
+                numbers = []
+                errors = []
+                size = 0
+
+        if len(docs) > 0 or len(errors) > 0 or state["first"]:
+            flush(docs, numbers, errors)
+
+        if state["errors"] == 0:
+            out('], "n" : %d, "ok" : 1}' % state["n"])
+        else:
+            out('], "n" : %d, "ok" : 0, "errmsg" : "%d documents weren\'t inserted"}' % (state["n"], state["errors"]))
+
+
+    def __read_ndjson(self, body):
+        """
+        one json document per line, blank lines are skipped
+        """
+        line_number = 0
+        for line in body:
+            line_number = line_number + 1
+            if len(line.strip()) == 0:
+                continue
+
+            try:
+                doc = codec.loads(line)
+            except (ValueError, TypeError):
+                yield (line_number, None, 0, "couldn't parse json")
+                continue
+
+            if not isinstance(doc, dict):
+                yield (line_number, None, 0, "not a document")
+                continue
+
+            yield (line_number, doc, len(line), None)
+
+
+    def __read_bson(self, body, conn):
+        """
+        concatenated bson documents, each starting with its length.  after
+        a bad length there's no telling where the next document starts, so
+        reading stops there.
+        """
+        max_size = getattr(conn, "max_bson_size", 16 * 1024 * 1024)
+
+        number = 0
+        while True:
+            header = body.read(4)
+            if len(header) == 0:
+                return
+            number = number + 1
+
+            if len(header) < 4:
+                yield (number, None, 0, "truncated document")
+                return
+
+            length = struct.unpack("<i", header)[0]
+            if length < 5 or length > max_size:
+                yield (number, None, 0, "invalid document length: %d" % length)
+                return
+
+            data = header + body.read(length - 4)
+            if len(data) < length:
+                yield (number, None, 0, "truncated document")
+                return
+
+            try:
+                doc = BSON(data).decode(as_class=SON)
+            except InvalidBSON, e:
+                yield (number, None, 0, "invalid bson: %s" % e)
+                continue
+
+            yield (number, doc, length, None)
+
+
+    def __insert_unordered(self, coll, docs):
+        """
+        returns how many docs were inserted and the write errors, with each
+        error's index into docs
+        """
+        if len(docs) == 0:
+            return (0, [])
+
+        bulk = coll.initialize_unordered_bulk_op()
+        for doc in docs:
+            bulk.insert(doc)
+
+        try:
+            result = bulk.execute()
+        except BulkWriteError, bwe:
+            result = bwe.details
+        except (AutoReconnect, OperationFailure), e:
+            return (0, [{"errmsg" : "%s" % e}])
+
+        errors = []
+        for error in result.get("writeErrors", []):
+            errors.append({"index" : error["index"], "code" : error["code"], "errmsg" : error["errmsg"]})
+        for error in result.get("writeConcernErrors", []):
+            errors.append({"code" : error["code"], "errmsg" : error["errmsg"]})
+
+        return (result["nInserted"], errors)
+
+
+    def __invalidate(self, name, db = None, collection = None):
+        """
+        forget cached results that a write could have changed
+        """
+        if self.query_cache == None:
+            return
+
+        if db == None:
+            self.query_cache.clear()
+        else:
+            self.query_cache.invalidate(name or "default", db, collection)
 
 
     def __safety_check(self, args, out, db):
@@ -377,7 +1530,7 @@ class MongoHandler:
 
         if safe:
             result = db.last_status()
-            out(json.dumps(result, default=json_util.default))
+            out(codec.dumps(result))
         else:
             out('{"ok" : 1}')
 
@@ -400,19 +1553,33 @@ class MongoHandler:
             out('{"ok" : 0, "errmsg" : "db and collection must be defined"}')
             return
         
-        if "criteria" not in args: 
-            out('{"ok" : 0, "errmsg" : "missing criteria"}')
-            return
-        criteria = self._get_son(args.getvalue('criteria'), out)
-        if criteria == None:
-            return
+        if getattr(args, "content_type", None) == "application/bson":
+            # the body is the criteria followed by newobj
+            docs = []
+            for (number, doc, size, errmsg) in self.__read_bson(args.body, conn):
+                if errmsg != None:
+                    out(codec.dumps({"ok" : 0, "errmsg" : "document %d: %s" % (number, errmsg)}))
+                    return
+                docs.append(doc)
+
+            if len(docs) != 2:
+                out('{"ok" : 0, "errmsg" : "expected criteria and newobj documents, got %d"}' % len(docs))
+                return
+            (criteria, newobj) = docs
+        else:
+            if "criteria" not in args:
+                out('{"ok" : 0, "errmsg" : "missing criteria"}')
+                return
+            criteria = self._get_son(args.getvalue('criteria'), out)
+            if criteria == None:
+                return
 
-        if "newobj" not in args:
-            out('{"ok" : 0, "errmsg" : "missing newobj"}')
-            return
-        newobj = self._get_son(args.getvalue('newobj'), out)
-        if newobj == None:
-            return
+            if "newobj" not in args:
+                out('{"ok" : 0, "errmsg" : "missing newobj"}')
+                return
+            newobj = self._get_son(args.getvalue('newobj'), out)
+            if newobj == None:
+                return
         
         upsert = False
         if "upsert" in args:
@@ -423,6 +1590,7 @@ class MongoHandler:
             multi = bool(args.getvalue('multi'))
 
         conn[db][collection].update(criteria, newobj, upsert=upsert, multi=multi)
+        self.__invalidate(name, db, collection)
 
         self.__safety_check(args, out, conn[db])
 
@@ -451,9 +1619,192 @@ class MongoHandler:
                 return
         
         result = conn[db][collection].remove(criteria)
+        self.__invalidate(name, db, collection)
 
         self.__safety_check(args, out, conn[db])
 
+    def _bulk(self, args, out, name = None, db = None, collection = None):
+        """
+        run a list of inserts, updates and removes as one bulk write.  ops
+        is a json list like:
+
+            [{"op" : "insert", "doc" : {...}},
+             {"op" : "update", "criteria" : {...}, "newobj" : {...}, "upsert" : true, "multi" : false},
+             {"op" : "remove", "criteria" : {...}, "multi" : true}]
+
+        or an application/x-ndjson body with one op per line.  they're run
+        in order, stopping at the first error, unless ordered is 0.
+        """
+
+        if type(args).__name__ == 'dict':
+            out('{"ok" : 0, "errmsg" : "_bulk must be a POST request"}')
+            return
+
+        conn = self._get_connection(name)
+        if conn == None:
+            out('{"ok" : 0, "errmsg" : "couldn\'t get connection to mongo"}')
+            return
+
+        if db == None or collection == None:
+            out('{"ok" : 0, "errmsg" : "db and collection must be defined"}')
+            return
+
+        ordered = True
+        if "ordered" in args:
+            ordered = args.getvalue('ordered').lower()
+            if ordered not in ("0", "1", "false", "true"):
+                out('{"ok" : 0, "errmsg" : "ordered must be 0 or 1"}')
+                return
+            ordered = ordered in ("1", "true")
+
+        if getattr(args, "content_type", None) == "application/x-ndjson":
+            ops = []
+            for (number, op, size, errmsg) in self.__read_ndjson(args.body):
+                if errmsg != None:
+                    out(codec.dumps({"ok" : 0, "errmsg" : "line %d: %s" % (number, errmsg)}))
+                    return
+                ops.append(op)
+        else:
+            if "ops" not in args:
+                out('{"ok" : 0, "errmsg" : "missing ops"}')
+                return
+            ops = self._get_son(args.getvalue('ops'), out)
+            if ops == None:
+                return
+
+        if not isinstance(ops, list) or len(ops) == 0:
+            out('{"ok" : 0, "errmsg" : "ops must be a non-empty list"}')
+            return
+
+        coll = conn[db][collection]
+        if ordered:
+            bulk = coll.initialize_ordered_bulk_op()
+        else:
+            bulk = coll.initialize_unordered_bulk_op()
+
+        # inserts get their _id here so each one can be reported
+        ids = {}
+        for (index, op) in enumerate(ops):
+            errmsg = self.__bulk_add(bulk, op)
+            if errmsg != None:
+                # nothing's been sent yet
+                out(codec.dumps({"ok" : 0, "errmsg" : "op %d: %s" % (index, errmsg)}))
+                return
+            if op["op"] == "insert":
+                ids[index] = op["doc"]["_id"]
+
+        try:
+            try:
+                result = bulk.execute()
+            except BulkWriteError, bwe:
+                result = bwe.details
+        except (AutoReconnect, OperationFailure), e:
+            out(codec.dumps({"ok" : 0, "errmsg" : "%s" % e}))
+            return
+        finally:
+            self.__invalidate(name, db, collection)
+
+        out(codec.dumps(self.__bulk_result(result, ops, ids, ordered)))
+
+
+    def __bulk_add(self, bulk, op):
+        """
+        add one of _bulk's ops to bulk, returns what's wrong with it if it
+        can't be
+        """
+        if not isinstance(op, dict) or op.get("op") not in ("insert", "update", "remove"):
+            return "op must be insert, update or remove"
+
+        if op["op"] == "insert":
+            doc = op.get("doc")
+            if not isinstance(doc, dict):
+                return "missing doc"
+            if "_id" not in doc:
+                doc["_id"] = ObjectId()
+            bulk.insert(doc)
+            return None
+
+        criteria = op.get("criteria", {})
+        if not isinstance(criteria, dict):
+            return "criteria must be a document"
+
+        if op["op"] == "remove":
+            if op.get("multi", True):
+                bulk.find(criteria).remove()
+            else:
+                bulk.find(criteria).remove_one()
+            return None
+
+        if "criteria" not in op:
+            return "missing criteria"
+        newobj = op.get("newobj")
+        if not isinstance(newobj, dict):
+            return "missing newobj"
+
+        selector = bulk.find(criteria)
+        if op.get("upsert", False):
+            selector = selector.upsert()
+
+        # like _update, a newobj without operators replaces the document
+        operators = len(newobj) > 0 and all(key.startswith("$") for key in newobj)
+        if op.get("multi", False):
+            if not operators:
+                return "multi updates need update operators"
+            selector.update(newobj)
+        elif operators:
+            selector.update_one(newobj)
+        else:
+            selector.replace_one(newobj)
+        return None
+
+
+    def __bulk_result(self, result, ops, ids, ordered):
+        """
+        the bulk write's totals plus a result for each op: ok, with the _id
+        of an insert or upsert, or the op's error.  in an ordered bulk
+        write, the ops after an error weren't run.
+        """
+        results = []
+        for index in range(len(ops)):
+            op_result = {"ok" : 1}
+            if index in ids:
+                op_result["_id"] = ids[index]
+            results.append(op_result)
+
+        for upserted in result.get("upserted", []):
+            if "_id" in upserted:
+                results[upserted["index"]]["_id"] = upserted["_id"]
+
+        write_errors = []
+        for error in result.get("writeErrors", []):
+            write_errors.append({"index" : error["index"], "code" : error["code"], "errmsg" : error["errmsg"]})
+            results[error["index"]] = {"ok" : 0, "code" : error["code"], "errmsg" : error["errmsg"]}
+
+        if ordered and len(write_errors) > 0:
+            for index in range(write_errors[0]["index"] + 1, len(ops)):
+                results[index] = {"ok" : 0, "errmsg" : "not run, an earlier op failed"}
+
+        write_concern_errors = []
+        for error in result.get("writeConcernErrors", []):
+            write_concern_errors.append({"code" : error["code"], "errmsg" : error["errmsg"]})
+
+        response = {"nInserted" : result.get("nInserted", 0),
+                    "nUpserted" : result.get("nUpserted", 0),
+                    "nMatched" : result.get("nMatched", 0),
+                    "nModified" : result.get("nModified"),
+                    "nRemoved" : result.get("nRemoved", 0),
+                    "results" : results,
+                    "writeErrors" : write_errors,
+                    "writeConcernErrors" : write_concern_errors,
+                    "ok" : 1}
+
+        failed = len(write_errors) + len(write_concern_errors)
+        if failed > 0:
+            response["ok"] = 0
+            response["errmsg"] = "%d write errors" % failed
+        return response
+
+
     def _batch(self, args, out, name = None, db = None, collection = None):
         """
         batch process commands
@@ -467,9 +1818,28 @@ class MongoHandler:
         if requests == None:
             return
 
-        out("[")
+        # a batch that's already running on a batch thread doesn't get to
+        # wait on the pool, or nested batches could use up every thread
+        parallel = False
+        if "parallel" in args and not getattr(MongoHandler._batch_local, "worker", False):
+            parallel = bool(args.getvalue("parallel"))
+
+        concurrency = MongoHandler.batch_concurrency
+        if "concurrency" in args:
+            concurrency = max(1, min(concurrency, int(args.getvalue("concurrency"))))
+
+        serial_writes = False
+        if "serial_writes" in args:
+            serial_writes = bool(args.getvalue("serial_writes"))
+
+        format = "json"
+        if "format" in args:
+            format = args.getvalue("format")
+            if format not in ("json", "bson"):
+                out('{"ok" : 0, "errmsg" : "unknown format: %s"}' % format)
+                return
 
-        first = True
+        calls = []
         for request in requests:
             if "cmd" not in request:
                 continue
@@ -496,31 +1866,121 @@ class MongoHandler:
 
             if method == "POST":
                 args = MongoFakeFieldStorage(args)
+            else:
+                # sub-requests answer in the batch's format
+                args = dict(args)
+                args['format'] = [format]
+
+            func = self.ops.get(cmd)
+            if func != None:
+                calls.append((func, args, name, db, collection, method == "POST"))
+
+        if format == "bson":
+            self.__start_bson(out)
+        else:
+            out("[")
+
+        # sub-requests don't get to touch the response's headers
+        out = getattr(out, "write", out)
+
+        if parallel:
+            self.__run_batch_parallel(calls, out, concurrency, serial_writes, format)
+        else:
+            # nothing to wait for, so sub-requests write straight to the
+            # client as they go
+            first = True
+            for (func, args, name, db, collection, write) in calls:
+                if format == "bson":
+                    if self.__batch_answers_bson(func, write):
+                        func(args, out, name = name, db = db, collection = collection)
+                    else:
+                        output = self.__run_batch_call(func, args, name, db, collection)
+                        out(self.__bson_envelope(output.get_ostream()))
+                    continue
 
-            func = getattr(MongoHandler.mh, cmd, None)
-            if callable(func):
-                output = MongoFakeStream()
-                func(args, output.ostream, name = name, db = db, collection = collection)
                 if not first:
                     out(",")
                 first = False
 
-                out(output.get_ostream())
-            else:
+                func(args, out, name = name, db = db, collection = collection)
+
+        if format != "bson":
+            out("]")
+
+    def __batch_answers_bson(self, func, write):
+        # only GET sub-requests are told the batch's format
+        return not write and func.__name__ in MongoHandler.bson_ops
+
+    def __run_batch_call(self, func, args, name, db, collection):
+        output = MongoFakeStream()
+        func(args, output.ostream, name = name, db = db, collection = collection)
+        return output
+
+    def __run_batch_worker(self, func, args, name, db, collection):
+        MongoHandler._batch_local.worker = True
+        try:
+            return self.__run_batch_call(func, args, name, db, collection)
+        finally:
+            MongoHandler._batch_local.worker = False
+
+    def __run_batch_parallel(self, calls, out, concurrency, serial_writes, format):
+        """
+        run up to concurrency sub-requests at a time, still writing their
+        results out in the order they were asked for.  with serial_writes,
+        a write waits for everything before it and finishes before anything
+        after it starts.
+        """
+        if self.batch_pool == None:
+            self.lock.acquire()
+            try:
+                if self.batch_pool == None:
+                    self.batch_pool = WorkerPool(MongoHandler.batch_concurrency, "batch")
+            finally:
+                self.lock.release()
+
+        running = collections.deque()
+        outputs = []
+
+        def emit(call, output):
+            if format == "bson":
+                if not self.__batch_answers_bson(call[0], call[5]):
+                    out(self.__bson_envelope(output.get_ostream()))
+                    return
+            elif len(outputs) > 0:
+                out(",")
+            outputs.append(True)
+
+            for part in output.parts:
+                out(part)
+
+        def wait():
+            (call, result) = running.popleft()
+            emit(call, result.get())
+
+        for call in calls:
+            if serial_writes and call[5]:
+                while len(running) > 0:
+                    wait()
+                emit(call, self.__run_batch_call(*call[:5]))
                 continue
 
-        out("]")
+            while len(running) >= concurrency:
+                wait()
+            running.append((call, self.batch_pool.submit(self.__run_batch_worker, *call[:5])))
+
+        while len(running) > 0:
+            wait()
 
         
 class MongoFakeStream:
     def __init__(self):
-        self.str = ""
+        self.parts = []
 
     def ostream(self, content):
-        self.str = self.str + content
+        self.parts.append(content)
 
     def get_ostream(self):
-        return self.str
+        return "".join(self.parts)
 
 class MongoFakeFieldStorage:
     def __init__(self, args):
@@ -531,3 +1991,13 @@ class MongoFakeFieldStorage:
 
     def __contains__(self, key):
         return key in self.args
+
+class MongoBodyFieldStorage(MongoFakeFieldStorage):
+    """
+    options from the query string, plus the raw request body for handlers
+    that read it themselves
+    """
+    def __init__(self, args, content_type, body):
+        MongoFakeFieldStorage.__init__(self, args)
+        self.content_type = content_type
+        self.body = body
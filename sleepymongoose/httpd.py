@@ -14,7 +14,13 @@
 
 from SocketServer import BaseServer
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from handlers import MongoHandler
+from handlers import MongoHandler, MongoBodyFieldStorage
+from pool import WorkerPool
+from asyncserver import MongoAsyncServer
+from static import MongoFileCache
+from profiler import MongoProfiler
+import codec
+import static
 
 try:
     from OpenSSL import SSL
@@ -22,10 +28,16 @@ except ImportError:
     pass
 
 import os.path, socket
+import select
 import urlparse
+import urllib
 import cgi
 import getopt
+import errno
+import signal
 import sys
+import time
+import zlib
 
 try:
     import json
@@ -57,9 +69,403 @@ class MongoServer(HTTPServer):
         self.server_bind()
         self.server_activate()
 
+    def shutdown_request(self, request):
+        # an ssl connection's shutdown sends close_notify, it doesn't take
+        # a direction like a socket's does
+        try:
+            request.shutdown()
+        except SSL.Error:
+            pass
+        self.close_request(request)
+
+
+class MongoSSLSocket:
+    """
+    an ssl connection that waits up to timeout seconds for the client.
+    pyOpenSSL doesn't wait on a socket with a timeout, it raises
+    WantReadError or WantWriteError, so this selects until it can go on.
+    """
+
+    def __init__(self, connection, timeout):
+        self.connection = connection
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def _wait(self, write):
+        if write:
+            ready = select.select([], [self.connection], [], self.timeout)[1]
+        else:
+            ready = select.select([self.connection], [], [], self.timeout)[0]
+        if len(ready) == 0:
+            raise socket.timeout("timed out")
+
+    def recv(self, size):
+        while True:
+            try:
+                return self.connection.recv(size)
+            except SSL.WantReadError:
+                self._wait(False)
+            except SSL.WantWriteError:
+                self._wait(True)
+            except SSL.ZeroReturnError:
+                return ""
+            except SSL.SysCallError, e:
+                # the client hung up without saying goodbye
+                if e.args[0] in (-1, "Unexpected EOF"):
+                    return ""
+                raise
+
+    def sendall(self, data):
+        while len(data) > 0:
+            try:
+                sent = self.connection.send(data)
+            except SSL.WantWriteError:
+                self._wait(True)
+                continue
+            except SSL.WantReadError:
+                self._wait(False)
+                continue
+            data = data[sent:]
+
+
+class MongoThreadPoolMixIn:
+    """
+    hand each accepted connection to a fixed pool of worker threads instead
+    of serving it on the accept loop
+    """
+
+    pool_size = 0
+    pool = None
+
+    def process_request(self, request, client_address):
+        if self.pool == None:
+            self.pool = WorkerPool(self.pool_size, "mongoose")
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+            self.shutdown_request(request)
+        except:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+
+class MongoThreadedServer(MongoThreadPoolMixIn, HTTPServer):
+    pass
+
+
+class MongoThreadedSecureServer(MongoThreadPoolMixIn, MongoServer):
+    pass
+
+
+class MongoResponseWriter:
+    """
+    collects a response as handlers write it.  a response that fits in the
+    buffer is sent with a Content-Length, a bigger one goes out in chunks
+    (or, for HTTP/1.0 clients, ends by closing the connection).  text
+    responses of at least compress_min_size bytes are gzipped or deflated
+    as they're written, if the client accepts it.  the writer is callable,
+    so it can be passed to a handler as its out function.
+    """
+
+    buffer_size = 8192
+
+    # 0 turns compression off
+    compress_level = 6
+    compress_min_size = 1024
+    compressible_types = ["application/json", "text/html", "text/css",
+                          "text/javascript", "text/plain"]
+
+    # a first write this short is kept for metrics, in case it's an error
+    error_size = 512
+
+    def __init__(self, request, content_type):
+        self.request = request
+        self.content_type = content_type
+        self.headers = []
+        self.buffer = []
+        self.size = 0
+        self.started = False
+        self.chunked = False
+
+        self.bytes = 0
+        self.write_seconds = 0.0
+        self.head = None
+
+        self.encoding = None
+        self.compressor = None
+        if self.compress_level > 0 and content_type in self.compressible_types:
+            self.encoding = self._negotiate(request.headers.get('Accept-Encoding', ''))
+
+    def __call__(self, content):
+        self.write(content)
+
+    def set_header(self, key, value):
+        self.headers.append((key, value))
+
+    def set_content_type(self, content_type):
+        self.content_type = content_type
+        if content_type not in self.compressible_types:
+            self.encoding = None
+
+    def write(self, content):
+        if len(content) == 0:
+            return
+
+        if self.head == None and len(content) < self.error_size:
+            self.head = content
+
+        self.buffer.append(content)
+        self.size = self.size + len(content)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        start = time.time()
+        self._flush()
+        self.write_seconds = self.write_seconds + time.time() - start
+
+    def _flush(self):
+        if not self.started:
+            self._compress(self.size)
+            self._start(None)
+
+        if self.size == 0:
+            return
+
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+
+        if self.compressor != None:
+            data = self.compressor.compress(data)
+        self._send(data)
+
+    def close(self):
+        start = time.time()
+        self._close()
+        self.write_seconds = self.write_seconds + time.time() - start
+
+    def _close(self):
+        if not self.started:
+            # the whole response is in the buffer, so it can be sent with
+            # its length
+            data = "".join(self.buffer)
+            self.buffer = []
+            self.size = 0
+
+            if self._compress(len(data)):
+                data = self.compressor.compress(data) + self.compressor.flush()
+                self.compressor = None
+
+            self._start(len(data))
+            self._send(data)
+            return
+
+        self._flush()
+        if self.compressor != None:
+            self._send(self.compressor.flush())
+
+        if self.chunked:
+            self.request.wfile.write("0\r\n\r\n")
+
+    def _send(self, data):
+        if len(data) == 0:
+            return
+
+        self.bytes = self.bytes + len(data)
+        if self.chunked:
+            self.request.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.request.wfile.write(data)
+
+    def _negotiate(self, accept_encoding):
+        """
+        the encoding to use, by the client's preference, gzip if it's a tie
+        """
+        best = None
+        best_q = 0
+        for coding in accept_encoding.split(','):
+            (name, semi, params) = coding.partition(';')
+            name = name.strip().lower()
+            if name not in ("gzip", "deflate"):
+                continue
+
+            q = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0
+
+            # q=0 means "not this one"
+            if q <= 0:
+                continue
+
+            if q > best_q or (q == best_q and name == "gzip"):
+                best = name
+                best_q = q
+
+        return best
+
+    def _compress(self, size):
+        """
+        decide whether to compress a response of size bytes, returns if it
+        will be
+        """
+        if self.encoding == None or size < self.compress_min_size:
+            return False
+
+        if self.encoding == "gzip":
+            wbits = 16 + zlib.MAX_WBITS
+        else:
+            wbits = zlib.MAX_WBITS
+
+        self.compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, wbits)
+        self.headers.append(('Content-Encoding', self.encoding))
+
+        # the compressed bytes aren't the ones the tag was made from
+        for i in range(len(self.headers)):
+            (key, value) = self.headers[i]
+            if key == 'ETag' and not value.startswith('W/'):
+                self.headers[i] = (key, 'W/' + value)
+        return True
+
+    def _start(self, length):
+        request = self.request
+
+        request.send_response(200, 'OK')
+        request.send_header('Content-type', self.content_type)
+        for header in request.response_headers:
+            request.send_header(header[0], header[1])
+        for header in self.headers:
+            request.send_header(header[0], header[1])
+
+        if self.compress_level > 0 and self.content_type in self.compressible_types:
+            request.send_header('Vary', 'Accept-Encoding')
+
+        if length != None:
+            request.send_header('Content-Length', str(length))
+        elif request.request_version >= "HTTP/1.1":
+            request.send_header('Transfer-Encoding', 'chunked')
+            self.chunked = True
+        else:
+            request.close_connection = 1
+
+        request.end_headers()
+        self.started = True
+
+
+class MongoBodyReader:
+    """
+    a file-like view of a request body that stops where the body does,
+    whether it's framed by a Content-Length or sent chunked
+    """
+
+    def __init__(self, rfile, length = None):
+        self.rfile = rfile
+        self.chunked = length == None
+        self.remaining = length or 0
+        self.started = False
+        self.done = not self.chunked
+
+    def exhausted(self):
+        return self.remaining == 0 and self.done
+
+    def _fill(self):
+        """
+        how much can be read before the next chunk boundary, reading chunk
+        headers as needed
+        """
+        if self.remaining == 0 and not self.done:
+            # the crlf after the previous chunk
+            if self.started:
+                self.rfile.readline()
+            self.started = True
+
+            line = self.rfile.readline()
+            try:
+                size = int(line.split(";")[0].strip(), 16)
+            except ValueError:
+                size = 0
+
+            if size == 0:
+                # trailers
+                while True:
+                    line = self.rfile.readline()
+                    if line in ("\r\n", "\n", ""):
+                        break
+                self.done = True
+
+            self.remaining = size
+
+        return self.remaining
+
+    def read(self, size = -1):
+        parts = []
+        while size != 0 and self._fill() > 0:
+            if size < 0:
+                n = self.remaining
+            else:
+                n = min(size, self.remaining)
+
+            data = self.rfile.read(n)
+            if len(data) == 0:
+                self.remaining = 0
+                self.done = True
+                break
+
+            self.remaining = self.remaining - len(data)
+            if size > 0:
+                size = size - len(data)
+            parts.append(data)
+
+        return "".join(parts)
+
+    def readline(self):
+        parts = []
+        while self._fill() > 0:
+            data = self.rfile.readline(self.remaining)
+            if len(data) == 0:
+                self.remaining = 0
+                self.done = True
+                break
+
+            self.remaining = self.remaining - len(data)
+            parts.append(data)
+            if data.endswith("\n"):
+                break
+
+        return "".join(parts)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if len(line) == 0:
+                return
+            yield line
+
 
 class MongoHTTPRequest(BaseHTTPRequestHandler):
 
+    # keep connections open between requests, and pipeline them, when
+    # they're served concurrently (see keep_alive)
+    protocol_version = "HTTP/1.1"
+
+    # an idle keep-alive connection gives up its thread after this many
+    # seconds, 0 turns keep-alive off
+    timeout = 5
+
+    # build each response up in a buffer instead of sending every header
+    # line as its own packet, and don't let nagle hold back the last piece
+    # of a response waiting for a delayed ack
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
     mimetypes = { "html" : "text/html",
                   "htm" : "text/html",
                   "gif" : "image/gif",
@@ -70,11 +476,47 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
                   "js" : "text/javascript",
                   "ico" : "image/vnd.microsoft.icon" }
 
+    # request bodies that are handed to handlers as a stream instead of
+    # being parsed as a form
+    body_types = ["application/x-ndjson", "application/bson"]
+
     docroot = "."
+    # small static files are kept in memory, None turns that off
+    file_cache = MongoFileCache(16 * 1024 * 1024)
+    profiler = MongoProfiler()
     mongos = []
+    event_loop = False
+    # prefork worker processes, 0 serves from this process
+    workers = 0
+    # seconds to wait before restarting a worker that died
+    respawn_delay = 1
     response_headers = []
     jsonp_callback = None;
 
+    @staticmethod
+    def keep_alive():
+        """
+        connections are only kept open when there are other threads (or
+        the event loop) to serve everyone else.  otherwise one idle client
+        would hold up all the others.
+        """
+        if not MongoHTTPRequest.timeout:
+            return False
+        return MongoHTTPRequest.event_loop or MongoThreadPoolMixIn.pool_size > 0
+
+    def handle(self):
+        if MongoHTTPRequest.keep_alive():
+            BaseHTTPRequestHandler.handle(self)
+            return
+
+        self.close_connection = 1
+        self.handle_one_request()
+
+    def send_response(self, code, message = None):
+        BaseHTTPRequestHandler.send_response(self, code, message)
+        if not MongoHTTPRequest.keep_alive():
+            self.send_header('Connection', 'close')
+
     def _parse_call(self, uri):
         """ 
         this turns a uri like: /foo/bar/_query into properties: using the db 
@@ -99,58 +541,84 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
     def call_handler(self, uri, args):
         """ execute something """
 
-        (db, collection, func_name) = self._parse_call(uri)
+        mh = MongoHandler.mh
+
+        plan = mh.call_plans.get(uri)
+        if plan == None:
+            plan = self._parse_call(uri)
+            if plan[0] != None and plan[2] in mh.ops:
+                mh.call_plans.put(uri, plan)
+        (db, collection, func_name) = plan
+
         if db == None or func_name == None:
             self.send_error(404, 'Script Not Found: '+uri)
             return
 
+        form = isinstance(args, dict)
+
         name = None
         if "name" in args:
-            if type(args).__name__ == "dict":
+            if form:
                 name = args["name"][0]
             else:
                 name = args.getvalue("name")
 
         self.jsonp_callback = None
         if "callback" in args:
-            if type(args).__name__ == "dict":
+            if form:
                 self.jsonp_callback = args["callback"][0]
             else:
                 self.jsonp_callback = args.getvalue("callback")
                 
-        func = getattr(MongoHandler.mh, func_name, None)
-        if callable(func):
-            self.send_response(200, 'OK')
-            self.send_header('Content-type', MongoHTTPRequest.mimetypes['json'])
-            for header in self.response_headers:
-                self.send_header(header[0], header[1])
-            self.end_headers()
+        func = mh.ops.get(func_name)
+        if func != None:
+            metrics = mh.metrics
+            start = metrics.start()
+            out = MongoResponseWriter(self, MongoHTTPRequest.mimetypes['json'])
 
-            if self.jsonp_callback:
-                func(args, self.prependJSONPCallback, name = name, db = db, collection = collection)
-            else:
-                func(args, self.wfile.write, name = name, db = db, collection = collection)
+            profiling = MongoHTTPRequest.profiler.wanted(self.headers)
+            try:
+                if self.jsonp_callback:
+                    out.write('%s(' % self.jsonp_callback)
+
+                if profiling:
+                    MongoHTTPRequest.profiler.run(func_name, out, profiling, func, args, out,
+                                                  name = name, db = db, collection = collection)
+                else:
+                    func(args, out, name = name, db = db, collection = collection)
+
+                if self.jsonp_callback:
+                    out.write(')')
 
+                out.close()
+            except Exception, e:
+                metrics.finish(func_name, start, out, "unhandled %s" % e.__class__.__name__)
+                raise
+
+            metrics.finish(func_name, start, out)
             return
         else:
             self.send_error(404, 'Script Not Found: '+uri)
             return            
-        
-    def prependJSONPCallback(self, str):
-        jsonp_output = '%s(' % self.jsonp_callback + str + ')'
-        self.wfile.write( jsonp_output )
-        
+
     # TODO: check for ..s
     def process_uri(self, method):
         if method == "GET":
             (uri, q, args) = self.path.partition('?')
         else:
-            uri = self.path
-            if 'Content-Type' in self.headers:
+            (uri, q, query) = self.path.partition('?')
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type in MongoHTTPRequest.body_types:
+                args = self._body_args(query, content_type)
+            elif 'Content-Type' in self.headers:
                 args = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
                                         environ={'REQUEST_METHOD':'POST',
                                                  'CONTENT_TYPE':self.headers['Content-Type']})
             else:
+                # we don't know where the body ends, so this connection
+                # can't be reused
+                self.close_connection = 1
+
                 self.send_response(100, "Continue")
                 self.send_header('Content-type', MongoHTTPRequest.mimetypes['json'])
                 for header in self.response_headers:
@@ -174,6 +642,24 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
 
         return (uri, args, type)
 
+    def _body_args(self, query, content_type):
+        """
+        options come from the query string, the body is left for the handler
+        to read
+        """
+        if 'Content-Length' in self.headers:
+            body = MongoBodyReader(self.rfile, int(self.headers['Content-Length']))
+        elif self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = MongoBodyReader(self.rfile)
+        else:
+            body = MongoBodyReader(self.rfile, 0)
+
+        params = {}
+        for (key, values) in urlparse.parse_qs(query).items():
+            params[key] = values[-1]
+
+        return MongoBodyFieldStorage(params, content_type, body)
+
 
     def do_GET(self):        
         (uri, args, type) = self.process_uri("GET")
@@ -181,34 +667,101 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
  
         # serve up a plain file
         if len(type) != 0:
-            if type in MongoHTTPRequest.mimetypes and os.path.exists(MongoHTTPRequest.docroot+uri):
+            self.serve_file(uri, type)
+            return
 
-                fh = open(MongoHTTPRequest.docroot+uri, 'r')
+        # make sure args is an array of tuples
+        if len(args) != 0:
+            args = urlparse.parse_qs(args)
+        else:
+            args = {}
 
-                self.send_response(200, 'OK')
-                self.send_header('Content-type', MongoHTTPRequest.mimetypes[type])
-                for header in self.response_headers:
-                    self.send_header(header[0], header[1])
-                self.end_headers()
-                self.wfile.write(fh.read())
+        self.call_handler(uri, args)
+        #self.wfile.write( self.path )
 
-                fh.close()
+    def serve_file(self, uri, type):
+        path = None
+        if type in MongoHTTPRequest.mimetypes:
+            path = static.resolve(MongoHTTPRequest.docroot, urllib.unquote(uri))
 
-                return
+        if path == None:
+            self.send_error(404, 'File Not Found: '+uri)
+            return
 
-            else:
-                self.send_error(404, 'File Not Found: '+uri)
+        st = os.stat(path)
+        content_type = MongoHTTPRequest.mimetypes[type]
+        headers = [('ETag', static.etag(st)),
+                   ('Last-Modified', static.last_modified(st)),
+                   ('Accept-Ranges', 'bytes')]
+
+        if static.not_modified(self.headers, st):
+            self.send_response(304, 'Not Modified')
+            for header in self.response_headers + headers:
+                self.send_header(header[0], header[1])
+            self.end_headers()
+            return
+
+        span = static.byte_range(self.headers, st)
+        if span == False:
+            self.send_response(416, 'Requested Range Not Satisfiable')
+            for header in self.response_headers:
+                self.send_header(header[0], header[1])
+            self.send_header('Content-Range', 'bytes */%d' % st.st_size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        cache = MongoHTTPRequest.file_cache
+        if span == None and cache != None and cache.cacheable(st):
+            out = MongoResponseWriter(self, content_type)
+            for header in headers:
+                out.set_header(header[0], header[1])
+            out.write(cache.read(path, st))
+            out.close()
+            return
+
+        if span == None:
+            # big text files are still worth compressing, a block at a time
+            out = MongoResponseWriter(self, content_type)
+            if out.encoding != None:
+                for header in headers:
+                    out.set_header(header[0], header[1])
 
+                fh = open(path, 'rb')
+                try:
+                    while True:
+                        data = fh.read(65536)
+                        if len(data) == 0:
+                            break
+                        out.write(data)
+                finally:
+                    fh.close()
+                out.close()
                 return
 
-        # make sure args is an array of tuples
-        if len(args) != 0:
-            args = urlparse.parse_qs(args)
+        # everything else goes out as it is
+        if span == None:
+            (first, last) = (0, st.st_size - 1)
+            self.send_response(200, 'OK')
         else:
-            args = {}
+            (first, last) = span
+            self.send_response(206, 'Partial Content')
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (first, last, st.st_size)))
+
+        self.send_header('Content-type', content_type)
+        for header in self.response_headers + headers:
+            self.send_header(header[0], header[1])
+        self.send_header('Content-Length', str(last - first + 1))
+        self.end_headers()
+
+        fh = open(path, 'rb')
+        try:
+            # requests run from the event loop don't have a socket of their own
+            connection = getattr(self, "connection", None)
+            static.send_file(connection, self.wfile, fh, first, last - first + 1)
+        finally:
+            fh.close()
 
-        self.call_handler(uri, args)
-        #self.wfile.write( self.path )
 
     def do_POST(self):
         (uri, args, type) = self.process_uri("POST")
@@ -216,15 +769,44 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
             return
         self.call_handler(uri, args)
 
+        # whatever the handler didn't read is still sitting in front of the
+        # next request
+        if isinstance(args, MongoBodyFieldStorage) and not args.body.exhausted():
+            self.close_connection = 1
+
     @staticmethod
     def serve_forever(port):
         print "\n================================="
         print "|      MongoDB REST Server      |"
         print "=================================\n"
 
-        if MongoServer.pem == None:
+        threaded = MongoThreadPoolMixIn.pool_size > 0
+
+        if MongoHTTPRequest.event_loop:
+            if MongoServer.pem != None:
+                print "the event loop server doesn't support ssl yet\n"
+                return
+
+            if threaded:
+                MongoAsyncServer.pool_size = MongoThreadPoolMixIn.pool_size
+
+            try:
+                server = MongoAsyncServer(('', port), MongoHTTPRequest)
+            except socket.error, (value, message):
+                if value == 98:
+                    print "could not bind to localhost:%d... is sleepy.mongoose already running?\n" % port
+                else:
+                    print message
+                return
+
+            print "serving requests from an event loop with %d threads\n" % MongoAsyncServer.pool_size
+        elif MongoServer.pem == None:
+            server_class = HTTPServer
+            if threaded:
+                server_class = MongoThreadedServer
+
             try:
-                server = HTTPServer(('', port), MongoHTTPRequest)
+                server = server_class(('', port), MongoHTTPRequest)
             except socket.error, (value, message):
                 if value == 98:
                     print "could not bind to localhost:%d... is sleepy.mongoose already running?\n" % port
@@ -233,11 +815,35 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
                 return
         else:
             print "--------Secure Connection--------\n"
-            server = MongoServer(('', port), MongoHTTPSRequest)
+            server_class = MongoServer
+            if threaded:
+                server_class = MongoThreadedSecureServer
+
+            server = server_class(('', port), MongoHTTPSRequest)
+
+        if threaded and not MongoHTTPRequest.event_loop:
+            print "serving requests with %d threads\n" % MongoThreadPoolMixIn.pool_size
+
+        threads = MongoThreadPoolMixIn.pool_size
+        if MongoHTTPRequest.event_loop:
+            threads = MongoAsyncServer.pool_size
+
+        # leave threads for everything else, and if there aren't enough to
+        # spare one, a waiting _tail would hold up every other request
+        if MongoHandler.max_tails == None:
+            MongoHandler.max_tails = threads / 2
+            if MongoHandler.max_tails == 0:
+                MongoHandler.max_tail_timeout = 0
+        elif threads == 0:
+            MongoHandler.max_tail_timeout = 0
+
+        if MongoHTTPRequest.workers > 0:
+            if not MongoHTTPRequest.prefork(server, MongoHTTPRequest.workers):
+                return
 
         MongoHandler.mh = MongoHandler(MongoHTTPRequest.mongos)
         
-        print "listening for connections on http://localhost:27080\n"
+        print "listening for connections on http://localhost:%d\n" % port
         try:
             server.serve_forever()
         except KeyboardInterrupt:
@@ -245,26 +851,140 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
             server.socket.close()
             print "\nGood bye!\n"
 
+    @staticmethod
+    def prefork(server, workers):
+        """
+        fork workers processes that all accept connections on server's
+        socket.  returns True in each worker, with MongoHandler.worker set
+        to its number.  the parent stays here restarting workers that die
+        until it's interrupted or terminated, then stops them all and
+        returns False.
+        """
+        MongoHandler.workers = workers
+        children = {}
+
+        def spawn(worker):
+            pid = os.fork()
+            if pid == 0:
+                # ctrl-c goes to the whole process group, let the parent
+                # decide what happens
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                MongoHandler.worker = worker
+                return True
+            children[pid] = worker
+            return False
+
+        def terminate(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, terminate)
+
+        for worker in range(workers):
+            if spawn(worker):
+                return True
+
+        print "forked %d worker processes\n" % workers
+        try:
+            while True:
+                try:
+                    (pid, status) = os.wait()
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                worker = children.pop(pid, None)
+                if worker == None:
+                    continue
+
+                print "worker %d exited with status %d, restarting it" % (worker, status)
+                # don't spin if it dies on startup
+                time.sleep(MongoHTTPRequest.respawn_delay)
+                if spawn(worker):
+                    return True
+        except KeyboardInterrupt:
+            print "\nShutting down the workers..."
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for pid in children:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            server.socket.close()
+            print "\nGood bye!\n"
+
+        return False
+
 
 class MongoHTTPSRequest(MongoHTTPRequest):
     def setup(self):
+        # what StreamRequestHandler.setup would do, on an ssl connection
         self.connection = self.request
-        self.rfile = socket._fileobject(self.request, "rb", self.rbufsize)
-        self.wfile = socket._fileobject(self.request, "wb", self.wbufsize)
+        if self.timeout:
+            self.connection.settimeout(self.timeout)
+            self.connection = MongoSSLSocket(self.request, self.timeout)
+        if self.disable_nagle_algorithm:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        self.rfile = socket._fileobject(self.connection, "rb", self.rbufsize)
+        self.wfile = socket._fileobject(self.connection, "wb", self.wbufsize)
 
 
 def usage():
-    print "python httpd.py [-x] [-d docroot/dir] [-s certificate.pem] [-m list,of,mongods]"
+    print "python httpd.py [-x] [-d docroot/dir] [-s certificate.pem] [-m list,of,mongods] [-t threads] [-w workers] [-a] [-p port]"
     print "\t-x|--xorigin\tAllow cross-origin http requests"
     print "\t-d|--docroot\tlocation from which to load files"
     print "\t-s|--secure\tlocation of .pem file if ssl is desired"
     print "\t-m|--mongos\tcomma-separated list of mongo servers to connect to"
+    print "\t-t|--threads\tnumber of worker threads to serve requests with (default: 0, serve one at a time)"
+    print "\t-p|--port\tport to listen on (default: 27080)"
+    print "\t-w|--workers\tnumber of processes to serve requests with, each with its own threads and cursors (default: 0, serve from this one)"
+    print "\t--idle-timeout\tseconds an idle keep-alive connection is kept open, 0 closes every connection after one request (default: 5).  connections are only kept open with -t or -a"
+    print "\t-a|--async\tmultiplex client connections on an event loop, running requests on -t threads (default: 10).  request bodies are read whole before the request runs"
+    print "\t--cursor-timeout\tseconds an unused cursor is kept open (default: 600)"
+    print "\t--max-cursors\tmaximum number of open cursors, least recently used are closed first (default: 1000)"
+    print "\t--coalesce-window\tmilliseconds to hold small _inserts so they're sent to the same collection together, 0 turns it off (default: 0)"
+    print "\t--coalesce-docs\tsend held _inserts as soon as there are this many documents (default: 100)"
+    print "\t--batch-concurrency\tmost sub-requests of a parallel _batch run at once (default: 8)"
+    print "\t--cache-ttl\tseconds to cache _find results for (default: 0, no caching)"
+    print "\t--cache-size\tmegabytes of _find results to cache (default: 64)"
+    print "\t--plan-cache-size\tparsed uris and _find arguments to keep, each (default: 1000)"
+    print "\t--tail-timeout\tseconds a _tail waits for new documents unless it asks otherwise (default: 30)"
+    print "\t--max-tails\tmost _tails waiting at once, each holds a thread, 0 is no limit (default: half of -t, and with fewer than 2 threads a _tail doesn't wait)"
+    print "\t--pool-size\tmaximum sockets per mongo connection (default: 100)"
+    print "\t--socket-timeout\tseconds to wait on a mongo socket (default: 2)"
+    print "\t--connect-timeout\tseconds to wait for a mongo connection (default: 2)"
+    print "\t--wait-queue-timeout\tseconds to wait for a free socket when the pool is full (default: forever)"
+    print "\t--wait-queue-multiple\tmaximum threads waiting for a socket, as a multiple of --pool-size (default: no limit)"
+    print "\t--health-interval\tseconds between mongo connection health checks, 0 turns them off (default: 10)"
+    print "\t--compress-level\tzlib level for gzip/deflate responses, 0 turns compression off (default: 6)"
+    print "\t--compress-min-size\tsmallest response, in bytes, to compress (default: 1024)"
+    print "\t--static-cache-size\tmegabytes of small docroot files to keep in memory, 0 turns it off (default: 16)"
+    print "\t--profile-dir\tdirectory to write cProfile dumps of profiled requests to"
+    print "\t--profile-token\tprofile requests that send this in an X-Mongoose-Profile header"
+    print "\t--profile-every\tprofile every nth request, needs --profile-dir (default: 0, never)"
+    print "\t--prefetch\tread the next batch of open cursors in the background"
+    print "\t--prefetch-budget\tmegabytes of prefetched documents to hold, in all (default: 64)"
+    print "\t--prefetch-cursor-budget\tkilobytes of prefetched documents to hold per cursor (default: 1024)"
+    print "\t--json\tjson library to use, json or simplejson (default: simplejson if its C speedups are installed)"
 
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "xd:s:m:", ["xorigin", "docroot=",
-            "secure=", "mongos="])
+        opts, args = getopt.getopt(sys.argv[1:], "xd:s:m:t:ap:w:", ["xorigin", "docroot=",
+            "secure=", "mongos=", "threads=", "async", "cursor-timeout=",
+            "max-cursors=", "batch-concurrency=", "cache-ttl=", "cache-size=",
+            "pool-size=", "socket-timeout=", "connect-timeout=", "wait-queue-timeout=",
+            "wait-queue-multiple=", "health-interval=", "json=", "compress-level=",
+            "compress-min-size=", "static-cache-size=", "port=", "profile-dir=",
+            "profile-token=", "profile-every=", "prefetch", "prefetch-budget=",
+            "prefetch-cursor-budget=", "workers=", "coalesce-window=", "coalesce-docs=",
+            "plan-cache-size=", "tail-timeout=", "max-tails=", "idle-timeout="])
+
+        port = 27080
 
         for o, a in opts:
             if o == "-d" or o == "--docroot":
@@ -277,13 +997,87 @@ def main():
                 MongoHTTPRequest.mongos = a.split(',')
             if o == "-x" or o == "--xorigin":
                 MongoHTTPRequest.response_headers.append(("Access-Control-Allow-Origin","*"))
+            if o == "-t" or o == "--threads":
+                MongoThreadPoolMixIn.pool_size = int(a)
+            if o == "-p" or o == "--port":
+                port = int(a)
+            if o == "-w" or o == "--workers":
+                MongoHTTPRequest.workers = int(a)
+            if o == "--idle-timeout":
+                MongoHTTPRequest.timeout = float(a) or None
+            if o == "-a" or o == "--async":
+                MongoHTTPRequest.event_loop = True
+            if o == "--cursor-timeout":
+                MongoHandler.cursor_timeout = int(a)
+            if o == "--max-cursors":
+                MongoHandler.max_cursors = int(a)
+            if o == "--coalesce-window":
+                MongoHandler.coalesce_window = float(a) / 1000
+            if o == "--coalesce-docs":
+                MongoHandler.coalesce_docs = int(a)
+            if o == "--batch-concurrency":
+                MongoHandler.batch_concurrency = int(a)
+            if o == "--cache-ttl":
+                MongoHandler.cache_ttl = float(a)
+            if o == "--cache-size":
+                MongoHandler.cache_size = int(a) * 1024 * 1024
+            if o == "--plan-cache-size":
+                MongoHandler.plan_cache_size = int(a)
+            if o == "--tail-timeout":
+                MongoHandler.tail_timeout = float(a)
+            if o == "--max-tails":
+                MongoHandler.max_tails = int(a)
+            if o == "--pool-size":
+                MongoHandler.pool_size = int(a)
+            if o == "--socket-timeout":
+                MongoHandler.socket_timeout = float(a)
+            if o == "--connect-timeout":
+                MongoHandler.connect_timeout = float(a)
+            if o == "--wait-queue-timeout":
+                MongoHandler.wait_queue_timeout = float(a)
+            if o == "--wait-queue-multiple":
+                MongoHandler.wait_queue_multiple = int(a)
+            if o == "--health-interval":
+                MongoHandler.health_interval = float(a)
+            if o == "--json":
+                codec.use(a)
+            if o == "--compress-level":
+                MongoResponseWriter.compress_level = int(a)
+            if o == "--compress-min-size":
+                MongoResponseWriter.compress_min_size = int(a)
+            if o == "--prefetch":
+                MongoHandler.prefetch = True
+            if o == "--prefetch-budget":
+                MongoHandler.prefetch_bytes = int(a) * 1024 * 1024
+            if o == "--prefetch-cursor-budget":
+                MongoHandler.prefetch_cursor_bytes = int(a) * 1024
+            if o == "--profile-dir":
+                if not os.path.isdir(a):
+                    raise ValueError("profile directory %s doesn't exist" % a)
+                MongoProfiler.directory = a
+            if o == "--profile-token":
+                MongoProfiler.token = a
+            if o == "--profile-every":
+                MongoProfiler.sample_every = int(a)
+            if o == "--static-cache-size":
+                if int(a) > 0:
+                    MongoHTTPRequest.file_cache = MongoFileCache(int(a) * 1024 * 1024)
+                else:
+                    MongoHTTPRequest.file_cache = None
+
+        if MongoProfiler.sample_every > 0 and MongoProfiler.directory == None:
+            raise ValueError("--profile-every needs a --profile-dir to write to")
 
     except getopt.GetoptError:
         print "error parsing cmd line args."
         usage()
         sys.exit(2)
+    except ValueError, e:
+        print e
+        usage()
+        sys.exit(2)
 
-    MongoHTTPRequest.serve_forever(27080)
+    MongoHTTPRequest.serve_forever(port)
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,206 @@
+# Copyright 2009-2010 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import re
+import threading
+import time
+
+import codec
+
+_number = re.compile(r'\d+')
+
+
+class MongoOpStats:
+    """
+    what's been recorded for one operation
+    """
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.encode_seconds = 0.0
+        self.write_seconds = 0.0
+        self.bytes = 0
+
+
+class MongoMetrics:
+    """
+    request counters and latency histograms by operation, in prometheus'
+    text format.  recording a request takes one lock and a bisect, so it's
+    cheap enough to leave on.
+
+    a request's time is split into encoding (in codec.dumps), writing the
+    response (compressing and sending it), and everything else, which is
+    mostly waiting on mongo.
+    """
+
+    # upper bounds, in seconds
+    buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1, 2.5, 5, 10]
+
+    # distinct (operation, errmsg) pairs to keep, the rest are counted as
+    # "other"
+    max_errors = 100
+
+    def __init__(self):
+        self.ops = {}
+        self.errors = {}
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        call when a request starts, returns what to pass to finish
+        """
+        self.lock.acquire()
+        self.in_flight = self.in_flight + 1
+        self.lock.release()
+
+        codec.timing.seconds = 0.0
+        return time.time()
+
+    def finish(self, op, start, out = None, error = None):
+        """
+        record a request to op.  out is the response writer, error is set if
+        the handler blew up.
+        """
+        seconds = time.time() - start
+        encode_seconds = codec.timing.seconds
+
+        write_seconds = 0.0
+        size = 0
+        errmsgs = []
+        if out != None:
+            write_seconds = out.write_seconds
+            size = out.bytes
+            if out.head != None:
+                errmsg = _errmsg(out.head)
+                if errmsg != None:
+                    errmsgs.append(errmsg)
+        if error != None:
+            errmsgs.append(error)
+
+        self.lock.acquire()
+        try:
+            self.in_flight = self.in_flight - 1
+
+            stats = self.ops.get(op)
+            if stats == None:
+                stats = self.ops[op] = MongoOpStats(self.buckets)
+
+            stats.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            stats.count = stats.count + 1
+            stats.seconds = stats.seconds + seconds
+            stats.encode_seconds = stats.encode_seconds + encode_seconds
+            stats.write_seconds = stats.write_seconds + write_seconds
+            stats.bytes = stats.bytes + size
+
+            for errmsg in errmsgs:
+                # what comes after a colon is usually the request's own
+                # input, and ids and counts would make every message
+                # different
+                errmsg = errmsg.split(":", 1)[0]
+                key = (op, _number.sub("N", errmsg)[:100])
+                if key not in self.errors and len(self.errors) >= self.max_errors:
+                    key = (op, "other")
+                self.errors[key] = self.errors.get(key, 0) + 1
+        finally:
+            self.lock.release()
+
+    def render(self, open_cursors):
+        lines = []
+
+        def metric(name, type, help):
+            lines.append("# HELP sleepymongoose_%s %s" % (name, help))
+            lines.append("# TYPE sleepymongoose_%s %s" % (name, type))
+
+        self.lock.acquire()
+        try:
+            ops = sorted(self.ops.items())
+
+            metric("request_seconds", "histogram", "Request latency by operation.")
+            for (op, stats) in ops:
+                total = 0
+                for i in range(len(self.buckets)):
+                    total = total + stats.counts[i]
+                    lines.append('sleepymongoose_request_seconds_bucket{op="%s",le="%s"} %d' %
+                                 (op, self.buckets[i], total))
+                lines.append('sleepymongoose_request_seconds_bucket{op="%s",le="+Inf"} %d' %
+                             (op, stats.count))
+                lines.append('sleepymongoose_request_seconds_sum{op="%s"} %f' % (op, stats.seconds))
+                lines.append('sleepymongoose_request_seconds_count{op="%s"} %d' % (op, stats.count))
+
+            metric("encode_seconds_total", "counter", "Time spent encoding json, by operation.")
+            for (op, stats) in ops:
+                lines.append('sleepymongoose_encode_seconds_total{op="%s"} %f' % (op, stats.encode_seconds))
+
+            metric("write_seconds_total", "counter", "Time spent compressing and sending responses, by operation.")
+            for (op, stats) in ops:
+                lines.append('sleepymongoose_write_seconds_total{op="%s"} %f' % (op, stats.write_seconds))
+
+            metric("mongo_seconds_total", "counter", "Time not spent encoding or writing, mostly waiting on mongo, by operation.")
+            for (op, stats) in ops:
+                mongo_seconds = max(0.0, stats.seconds - stats.encode_seconds - stats.write_seconds)
+                lines.append('sleepymongoose_mongo_seconds_total{op="%s"} %f' % (op, mongo_seconds))
+
+            metric("response_bytes_total", "counter", "Response body bytes sent, by operation.")
+            for (op, stats) in ops:
+                lines.append('sleepymongoose_response_bytes_total{op="%s"} %d' % (op, stats.bytes))
+
+            metric("errors_total", "counter", "Error responses by operation and errmsg.")
+            for ((op, errmsg), count) in sorted(self.errors.items()):
+                lines.append('sleepymongoose_errors_total{op="%s",errmsg="%s"} %d' %
+                             (op, _escape(errmsg), count))
+
+            metric("in_flight_requests", "gauge", "Requests being handled.")
+            lines.append("sleepymongoose_in_flight_requests %d" % self.in_flight)
+        finally:
+            self.lock.release()
+
+        metric("open_cursors", "gauge", "Cursors open for _more.")
+        lines.append("sleepymongoose_open_cursors %d" % open_cursors)
+
+        return "\n".join(lines) + "\n"
+
+
+def _errmsg(head):
+    """
+    the errmsg of a response that starts with an error envelope, like
+    {"ok" : 0, "errmsg" : "..."}.  an errmsg further down, in a result
+    document or a _batch's sub-response, isn't the request's error.
+    """
+    if not head.startswith("{"):
+        return None
+
+    try:
+        response = codec.loads(head)
+    except (ValueError, TypeError):
+        # just the start of a longer response
+        return None
+
+    if not isinstance(response, dict) or response.get("ok", 1):
+        return None
+
+    errmsg = response.get("errmsg")
+    if isinstance(errmsg, unicode):
+        errmsg = errmsg.encode("utf-8")
+    if not isinstance(errmsg, str):
+        return None
+    return errmsg
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
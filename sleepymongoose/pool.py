@@ -0,0 +1,70 @@
+# Copyright 2009-2010 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+import Queue
+
+class WorkerPool:
+    """
+    a fixed number of daemon threads pulling (func, args) off a shared queue
+    """
+
+    def __init__(self, size, name = "worker"):
+        self.size = size
+        self.tasks = Queue.Queue()
+        self.threads = []
+
+        for i in range(size):
+            thread = threading.Thread(target = self._work, name = "%s-%d" % (name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            (func, args, result) = self.tasks.get()
+            try:
+                result._set(func(*args), None)
+            except:
+                result._set(None, sys.exc_info())
+
+    def submit(self, func, *args):
+        """
+        queue func(*args) and return a WorkerResult to wait on
+        """
+        result = WorkerResult()
+        self.tasks.put((func, args, result))
+        return result
+
+
+class WorkerResult:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def _set(self, value, exc_info):
+        self.value = value
+        self.exc_info = exc_info
+        self.done.set()
+
+    def get(self, timeout = None):
+        """
+        wait for the task to finish, re-raising anything it raised
+        """
+        self.done.wait(timeout)
+        if self.exc_info != None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
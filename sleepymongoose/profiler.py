@@ -0,0 +1,143 @@
+# Copyright 2009-2010 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import hmac
+import os
+import pstats
+import threading
+import time
+
+
+class MongoProfiler:
+    """
+    profiles handler calls with cProfile when a request asks for it with
+    the right token in its X-Mongoose-Profile header, or on every
+    sample_every'th request.  profiles are dumped to directory (only the
+    newest max_files are kept).  a request that sent the token also gets
+    the dump's file name and, if the response hasn't started yet, a short
+    summary back in headers.
+
+    everything is off unless a token or a directory is configured.
+    """
+
+    header = "X-Mongoose-Profile"
+
+    token = None
+    directory = None
+    sample_every = 0
+    max_files = 100
+
+    # functions listed in the summary
+    summary_size = 3
+
+    def __init__(self):
+        self.requests = 0
+        self.dumps = 0
+        self.files = []
+        self.lock = threading.Lock()
+
+    def wanted(self, headers):
+        """
+        "header" if the request asked to be profiled, "sample" if it's its
+        turn, None if it shouldn't be profiled
+        """
+        if MongoProfiler.token != None:
+            value = headers.get(MongoProfiler.header)
+            if value != None and _same(value.strip(), MongoProfiler.token):
+                return "header"
+
+        if MongoProfiler.sample_every > 0 and MongoProfiler.directory != None:
+            self.lock.acquire()
+            try:
+                self.requests = self.requests + 1
+                if self.requests % MongoProfiler.sample_every == 0:
+                    return "sample"
+            finally:
+                self.lock.release()
+
+        return None
+
+    def run(self, op, out, reason, func, *args, **kwargs):
+        """
+        call func under the profiler.  op is used in the dump's file name,
+        out is the response writer and reason is what wanted said.
+        """
+        # only someone with the token gets to see anything
+        inline = reason == "header"
+
+        path = None
+        if MongoProfiler.directory != None:
+            path = self._path(op)
+            if inline:
+                out.set_header(MongoProfiler.header + "-File", os.path.basename(path))
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            if path != None:
+                profile.dump_stats(path)
+                self._keep(path)
+            if inline and not out.started:
+                out.set_header(MongoProfiler.header + "-Summary", self.summary(profile))
+
+    def summary(self, profile):
+        stats = pstats.Stats(profile)
+
+        top = sorted(stats.stats.items(), key = lambda item: item[1][3], reverse = True)
+        parts = ["%.1fms %d calls" % (stats.total_tt * 1000, stats.total_calls)]
+        for ((filename, line, function), (cc, nc, tt, ct, callers)) in top:
+            # the profiler's own entries and builtins aren't interesting
+            if line == 0 or filename == __file__.rstrip("co"):
+                continue
+            parts.append("%s:%d(%s) %.1fms" % (os.path.basename(filename), line, function, ct * 1000))
+            if len(parts) > MongoProfiler.summary_size:
+                break
+
+        return "; ".join(parts)
+
+    def _path(self, op):
+        self.lock.acquire()
+        try:
+            self.dumps = self.dumps + 1
+            count = self.dumps
+        finally:
+            self.lock.release()
+
+        filename = "%s-%d-%s.prof" % (time.strftime("%Y%m%d-%H%M%S"), count, op.strip("_"))
+        return os.path.join(MongoProfiler.directory, filename)
+
+    def _keep(self, path):
+        self.lock.acquire()
+        try:
+            self.files.append(path)
+            old = self.files[:-MongoProfiler.max_files]
+            self.files = self.files[-MongoProfiler.max_files:]
+        finally:
+            self.lock.release()
+
+        for path in old:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _same(a, b):
+    # don't leak the token through how long the comparison takes
+    compare = getattr(hmac, "compare_digest", None)
+    if compare != None:
+        return compare(a, b)
+    return a == b
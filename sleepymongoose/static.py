@@ -0,0 +1,232 @@
+# Copyright 2009-2010 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Helpers for serving files out of the docroot: finding them safely, caching
+the small ones, conditional GET and byte ranges, and sending the big ones
+with sendfile(2) when the pysendfile module is installed.
+"""
+
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+import errno
+import os
+import select
+import socket
+import threading
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+
+def resolve(docroot, uri):
+    """
+    the real path of uri under docroot, or None if it isn't a file in there
+    (symlinks and ..s included)
+    """
+    root = os.path.realpath(docroot)
+    path = os.path.realpath(os.path.join(root, uri))
+
+    if not path.startswith(root + os.sep):
+        return None
+    if not os.path.isfile(path):
+        return None
+
+    return path
+
+
+def etag(st):
+    return '"%x-%x"' % (int(st.st_mtime), st.st_size)
+
+
+def last_modified(st):
+    return formatdate(int(st.st_mtime), usegmt = True)
+
+
+def not_modified(headers, st):
+    """
+    if the client's copy, going by If-None-Match or If-Modified-Since, is
+    still good
+    """
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match != None:
+        tag = etag(st)
+        for candidate in if_none_match.split(','):
+            candidate = candidate.strip()
+            # a compressed response's tag is weak, but it's the same file
+            if candidate.startswith('W/'):
+                candidate = candidate[2:]
+            if candidate == tag or candidate == '*':
+                return True
+        return False
+
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since != None:
+        date = parsedate_tz(if_modified_since)
+        if date != None:
+            return int(st.st_mtime) <= mktime_tz(date)
+
+    return False
+
+
+def byte_range(headers, st):
+    """
+    the (first, last) byte asked for by a Range header, None to send the
+    whole file, or False if the range can't be satisfied.  only single
+    ranges are supported, anything else gets the whole file.
+    """
+    header = headers.get('Range')
+    if header == None or not header.startswith('bytes='):
+        return None
+
+    # the range only applies if the file hasn't changed since the client
+    # got its piece
+    if_range = headers.get('If-Range')
+    if if_range != None and if_range != etag(st) and if_range != last_modified(st):
+        return None
+
+    spec = header[len('bytes='):].strip()
+    if ',' in spec:
+        return None
+
+    (first, dash, last) = spec.partition('-')
+    size = st.st_size
+    try:
+        if first == '':
+            # the last n bytes
+            n = int(last)
+            if n <= 0:
+                return False
+            return (max(0, size - n), size - 1)
+
+        first = int(first)
+        if last == '':
+            last = size - 1
+        else:
+            last = min(int(last), size - 1)
+    except ValueError:
+        return None
+
+    if first >= size or first > last:
+        return False
+
+    return (first, last)
+
+
+class MongoFileCache:
+    """
+    the contents of small files, least recently used are dropped to stay
+    under max_bytes.  an entry is only used while the file's mtime and size
+    are what they were when it was read.
+    """
+
+    # files bigger than this aren't cached
+    max_file_size = 256 * 1024
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+        # path -> (mtime, size, data), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def cacheable(self, st):
+        return st.st_size <= self.max_file_size and st.st_size <= self.max_bytes
+
+    def read(self, path, st):
+        """
+        the file's contents, from the cache if they haven't changed
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(path, None)
+            if entry != None:
+                self.size = self.size - len(entry[2])
+                if entry[0] == st.st_mtime and entry[1] == st.st_size:
+                    self.entries[path] = entry
+                    self.size = self.size + len(entry[2])
+                    return entry[2]
+        finally:
+            self.lock.release()
+
+        fh = open(path, 'rb')
+        try:
+            data = fh.read()
+        finally:
+            fh.close()
+
+        # it changed while we were reading it, try again next time
+        if len(data) != st.st_size:
+            return data
+
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(path, None)
+            if old != None:
+                self.size = self.size - len(old[2])
+
+            self.entries[path] = (st.st_mtime, st.st_size, data)
+            self.size = self.size + len(data)
+
+            while self.size > self.max_bytes:
+                (old_path, old) = self.entries.popitem(last = False)
+                self.size = self.size - len(old[2])
+        finally:
+            self.lock.release()
+
+        return data
+
+
+def send_file(connection, wfile, fh, offset, count):
+    """
+    send count bytes of fh, starting at offset.  that's done by the kernel
+    if sendfile is available and the connection is a plain socket, and by
+    copying through wfile otherwise.
+    """
+    if sendfile != None and isinstance(connection, socket.socket):
+        wfile.flush()
+
+        timeout = connection.gettimeout()
+        out_fd = connection.fileno()
+        in_fd = fh.fileno()
+        while count > 0:
+            try:
+                sent = sendfile(out_fd, in_fd, offset, count)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                # sockets with a timeout are non-blocking underneath
+                (r, w, x) = select.select([], [out_fd], [], timeout)
+                if len(w) == 0:
+                    raise socket.timeout("timed out sending a file")
+                continue
+
+            if sent == 0:
+                break
+            offset = offset + sent
+            count = count - sent
+        return
+
+    fh.seek(offset)
+    while count > 0:
+        data = fh.read(min(count, 65536))
+        if len(data) == 0:
+            break
+        wfile.write(data)
+        count = count - len(data)
+
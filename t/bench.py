@@ -0,0 +1,404 @@
+"""
+Load test for sleepy.mongoose.
+
+Starts httpd.py in a child process, backed by the in-memory MongoStub
+instead of a mongod, seeds it with documents, then runs each scenario with
+several client processes on keep-alive connections:
+
+    find    _find then _more until the cursor is exhausted
+    insert  _insert of a batch of documents
+    batch   _batch of a few finds and an insert
+    static  a small html page and a large image from the docroot
+
+For each scenario it reports requests/second, p50/p99/max latency and the
+server's RSS, and writes everything to a json file that --compare can diff
+against a later run.
+
+    python t/bench.py [-c clients] [-d seconds] [-s find,insert,...] [-o out.json]
+                      [--compare old.json] [-- httpd options]
+
+e.g. python t/bench.py -c 8 -- -t 16
+"""
+
+import getopt
+import httplib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+scenarios = ["find", "insert", "batch", "static"]
+
+failed = re.compile(r'"ok"\s*:\s*0\b')
+
+defaults = {"clients" : 4, "duration" : 10.0, "warmup" : 1.0, "docs" : 10000,
+            "batch_size" : 20, "insert_docs" : 100, "latency" : 0.0,
+            "scenarios" : scenarios, "output" : "bench.json",
+            "compare" : None, "server_args" : []}
+
+
+def serve(args):
+    """
+    the child process: httpd.py with MongoStub standing in for pymongo
+    """
+    sys.path.insert(0, os.path.join(here, "..", "sleepymongoose"))
+    sys.path.insert(0, here)
+
+    import handlers
+    import httpd
+    from mongostub import MongoStub
+
+    handlers.MongoHandler.connection_class = MongoStub
+    MongoStub.latency = float(os.environ.get("BENCH_LATENCY", 0))
+    # a log line per request would be most of what we measured
+    httpd.MongoHTTPRequest.log_message = lambda self, *args: None
+
+    sys.argv = ["httpd.py"] + args
+    httpd.main()
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_server(options, docroot):
+    port = free_port()
+    args = ["-d", docroot, "-p", str(port)] + options["server_args"]
+
+    env = dict(os.environ)
+    env["BENCH_LATENCY"] = str(options["latency"])
+
+    devnull = open(os.devnull, "w")
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", "--"] + args,
+                             stdout = devnull, env = env)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if child.poll() != None:
+            raise Exception("the server exited with %d" % child.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return (child, port)
+        except socket.error:
+            time.sleep(0.1)
+
+    child.kill()
+    raise Exception("the server didn't start listening on %d" % port)
+
+
+def rss(pid):
+    """
+    (current, peak) resident set size of pid in KB, None if we can't tell
+    """
+    try:
+        status = open("/proc/%d/status" % pid).read()
+    except IOError:
+        try:
+            current = int(subprocess.check_output(["ps", "-o", "rss=", "-p", str(pid)]).strip())
+            return (current, None)
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            return (None, None)
+
+    values = {}
+    for line in status.splitlines():
+        (key, sep, value) = line.partition(":")
+        if key in ("VmRSS", "VmHWM"):
+            values[key] = int(value.split()[0])
+    return (values.get("VmRSS"), values.get("VmHWM"))
+
+
+def make_doc(i):
+    return {"i" : i, "group" : i % 100, "name" : "document %d" % i,
+            "tags" : ["a", "b", "c"][:i % 4], "payload" : "x" * 100}
+
+
+def make_docroot():
+    docroot = tempfile.mkdtemp(prefix = "mongoose-bench-")
+
+    f = open(os.path.join(docroot, "small.html"), "w")
+    f.write("<html><body>%s</body></html>" % ("<p>sleepy.mongoose</p>\n" * 200))
+    f.close()
+
+    f = open(os.path.join(docroot, "large.png"), "wb")
+    f.write(os.urandom(1024 * 1024))
+    f.close()
+
+    return docroot
+
+
+class Client:
+    """
+    one keep-alive connection, timing every request
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = None
+        self.latencies = []
+        self.errors = 0
+
+    def request(self, method, path, params = None, headers = {}, check = True):
+        body = None
+        headers = dict(headers)
+        if params != None:
+            body = urllib.urlencode(params)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        start = time.time()
+        try:
+            if self.conn == None:
+                self.conn = httplib.HTTPConnection("127.0.0.1", self.port, timeout = 30)
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            data = response.read()
+            status = response.status
+        except (httplib.HTTPException, socket.error):
+            self.conn = None
+            self.errors = self.errors + 1
+            return None
+
+        self.latencies.append(time.time() - start)
+        if status != 200 or (check and failed.search(data[:4096])):
+            self.errors = self.errors + 1
+            return None
+
+        return data
+
+    def find(self, options):
+        criteria = json.dumps({"group" : random.randint(0, 99)})
+        batch_size = options["batch_size"]
+
+        data = self.request("GET", "/bench/docs/_find?" + urllib.urlencode({
+            "criteria" : criteria, "batch_size" : batch_size}))
+        while data != None:
+            result = json.loads(data)
+            if result["ok"] == 0:
+                self.errors = self.errors + 1
+                break
+            if len(result["results"]) < batch_size:
+                break
+            data = self.request("GET", "/bench/docs/_more?" + urllib.urlencode({
+                "id" : result["id"], "batch_size" : batch_size}), check = False)
+
+    def insert(self, options):
+        start = random.randint(0, 1000000)
+        docs = [make_doc(i) for i in range(start, start + options["insert_docs"])]
+        self.request("POST", "/bench/inserts/_insert", {"docs" : json.dumps(docs)})
+
+    def batch(self, options):
+        requests = []
+        for i in range(3):
+            requests.append({"cmd" : "_find", "db" : "bench", "collection" : "docs",
+                             "args" : {"criteria" : [json.dumps({"group" : random.randint(0, 99)})],
+                                       "limit" : ["20"], "batch_size" : ["20"]}})
+        requests.append({"cmd" : "_insert", "method" : "POST", "db" : "bench",
+                         "collection" : "inserts",
+                         "args" : {"docs" : json.dumps([make_doc(i) for i in range(10)])}})
+        self.request("POST", "/bench/_batch", {"requests" : json.dumps(requests)})
+
+    def static(self, options):
+        headers = {"Accept-Encoding" : "gzip"}
+        self.request("GET", "/small.html", headers = headers)
+        self.request("GET", "/large.png", headers = headers)
+
+
+def run_client(port, scenario, options, seconds, results):
+    random.seed()
+    client = Client(port)
+    op = getattr(client, scenario)
+
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        op(options)
+
+    results.put((client.latencies, client.errors))
+
+
+def run_scenario(port, pid, scenario, options):
+    results = multiprocessing.Queue()
+
+    for (seconds, keep) in ((options["warmup"], False), (options["duration"], True)):
+        if seconds <= 0:
+            continue
+
+        clients = []
+        for i in range(options["clients"]):
+            p = multiprocessing.Process(target = run_client,
+                                        args = (port, scenario, options, seconds, results))
+            p.start()
+            clients.append(p)
+
+        start = time.time()
+        latencies = []
+        errors = 0
+        for p in clients:
+            (client_latencies, client_errors) = results.get()
+            latencies.extend(client_latencies)
+            errors = errors + client_errors
+        elapsed = time.time() - start
+
+        for p in clients:
+            p.join()
+
+    latencies.sort()
+
+    def percentile(q):
+        if len(latencies) == 0:
+            return None
+        return round(latencies[int(q * (len(latencies) - 1))] * 1000, 3)
+
+    (current, peak) = rss(pid)
+    return {"requests" : len(latencies), "errors" : errors,
+            "seconds" : round(elapsed, 3),
+            "requests_per_second" : round(len(latencies) / elapsed, 1),
+            "p50_ms" : percentile(0.5), "p99_ms" : percentile(0.99),
+            "max_ms" : percentile(1.0), "rss_kb" : current, "peak_rss_kb" : peak}
+
+
+def seed(port, options):
+    client = Client(port)
+    for start in range(0, options["docs"], 1000):
+        docs = [make_doc(i) for i in range(start, min(options["docs"], start + 1000))]
+        if client.request("POST", "/bench/docs/_insert", {"docs" : json.dumps(docs)}) == None:
+            raise Exception("couldn't seed the stub")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd = here,
+                                       stderr = open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    print "\n%-8s %22s %22s %22s" % ("", "req/s", "p50 ms", "p99 ms")
+    for (scenario, result) in sorted(new["results"].items()):
+        before = old["results"].get(scenario)
+        if before == None:
+            continue
+
+        columns = []
+        for key in ("requests_per_second", "p50_ms", "p99_ms"):
+            if not before[key] or result[key] == None:
+                columns.append("%22s" % "-")
+                continue
+            change = (result[key] - before[key]) * 100.0 / before[key]
+            columns.append("%10s -> %-8s%+.0f%%" % (before[key], result[key], change))
+        print "%-8s %s" % (scenario, " ".join(columns))
+
+
+def usage():
+    print __doc__.strip()
+    print
+    print "\t-c|--clients\tclient processes (default: %d)" % defaults["clients"]
+    print "\t-d|--duration\tseconds to run each scenario for (default: %d)" % defaults["duration"]
+    print "\t-s|--scenarios\tcomma-separated scenarios to run (default: %s)" % ",".join(scenarios)
+    print "\t-o|--output\tfile to write results to (default: %s)" % defaults["output"]
+    print "\t--warmup\tseconds to run each scenario before measuring (default: %d)" % defaults["warmup"]
+    print "\t--docs\tdocuments to seed the stub with (default: %d)" % defaults["docs"]
+    print "\t--batch-size\t_find/_more batch size (default: %d)" % defaults["batch_size"]
+    print "\t--insert-docs\tdocuments per _insert (default: %d)" % defaults["insert_docs"]
+    print "\t--latency\tsimulated milliseconds per mongo round trip (default: 0)"
+    print "\t--compare\tearlier results file to compare with"
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        serve(sys.argv[3:])
+        return
+
+    options = dict(defaults)
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c:d:s:o:h", ["clients=", "duration=",
+            "scenarios=", "output=", "warmup=", "docs=", "batch-size=", "insert-docs=",
+            "latency=", "compare=", "help"])
+
+        for o, a in opts:
+            if o == "-c" or o == "--clients":
+                options["clients"] = int(a)
+            if o == "-d" or o == "--duration":
+                options["duration"] = float(a)
+            if o == "-s" or o == "--scenarios":
+                options["scenarios"] = a.split(",")
+            if o == "-o" or o == "--output":
+                options["output"] = a
+            if o == "--warmup":
+                options["warmup"] = float(a)
+            if o == "--docs":
+                options["docs"] = int(a)
+            if o == "--batch-size":
+                options["batch_size"] = int(a)
+            if o == "--insert-docs":
+                options["insert_docs"] = int(a)
+            if o == "--latency":
+                options["latency"] = float(a) / 1000
+            if o == "--compare":
+                options["compare"] = a
+            if o == "-h" or o == "--help":
+                usage()
+                return
+    except (getopt.GetoptError, ValueError), e:
+        print e
+        usage()
+        sys.exit(2)
+
+    if options["duration"] <= 0:
+        print "the duration has to be more than 0"
+        sys.exit(2)
+
+    for scenario in options["scenarios"]:
+        if scenario not in scenarios:
+            print "unknown scenario: %s" % scenario
+            sys.exit(2)
+
+    options["server_args"] = args
+
+    docroot = make_docroot()
+    (child, port) = start_server(options, docroot)
+    try:
+        seed(port, options)
+
+        results = {}
+        for scenario in options["scenarios"]:
+            result = run_scenario(port, child.pid, scenario, options)
+            results[scenario] = result
+            print "%-8s %8d requests %6d errors %10.1f req/s   p50 %8s ms   p99 %8s ms   rss %s KB" % (
+                scenario, result["requests"], result["errors"], result["requests_per_second"],
+                result["p50_ms"], result["p99_ms"], result["rss_kb"])
+    finally:
+        child.terminate()
+        child.wait()
+        shutil.rmtree(docroot)
+
+    output = options.pop("output")
+    compare_with = options.pop("compare")
+    report = {"time" : time.strftime("%Y-%m-%dT%H:%M:%S"), "revision" : git_revision(),
+              "python" : platform.python_version(), "platform" : platform.platform(),
+              "options" : options, "results" : results}
+
+    f = open(output, "w")
+    json.dump(report, f, indent = 2, sort_keys = True)
+    f.close()
+
+    if compare_with != None:
+        compare(json.load(open(compare_with)), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sleepymongoose"))
+
+from bson.objectid import ObjectId
+import codec
+
+class TestCodec(unittest.TestCase):
+
+    docs = [{"x" : float("nan")},
+            {"x" : float("inf"), "y" : float("-inf")},
+            {"_id" : ObjectId("4c8a331bda76c559ef000004"), "a" : [1, 2.5, None, True],
+             "b" : {"c" : u"\u00e9"}, "d" : 2 ** 64}]
+
+    def tearDown(self):
+        codec.use("json")
+        if codec.simplejson != None:
+            codec.use("simplejson")
+
+    def _round_trip(self, backend):
+        codec.use(backend)
+        return [codec.dumps(doc) for doc in self.docs]
+
+    def test_non_finite(self):
+        codec.use("json")
+        self.assertEquals(codec.dumps({"x" : float("inf")}), '{"x": Infinity}')
+
+        doc = codec.loads(codec.dumps(self.docs[0]))
+        self.assertTrue(doc["x"] != doc["x"])
+
+        doc = codec.loads(codec.dumps(self.docs[1]))
+        self.assertEquals(doc["x"], float("inf"))
+        self.assertEquals(doc["y"], float("-inf"))
+
+    def test_backends_match(self):
+        if codec.simplejson == None:
+            return
+
+        self.assertEquals(self._round_trip("json"), self._round_trip("simplejson"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,30 @@
 from restclient import GET, POST
+from bson import decode_all
 
+import httplib
 import json
 import unittest
+import urllib
+import zlib
+
+def request(method, path, params, headers = {}):
+    """
+    returns the response as well as its body, for its headers
+    """
+    conn = httplib.HTTPConnection("localhost", 27080)
+    try:
+        if method == "GET":
+            if len(params) > 0:
+                path = path + "?" + urllib.urlencode(params)
+            conn.request("GET", path, None, headers)
+        else:
+            headers = dict(headers)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            conn.request("POST", path, urllib.urlencode(params), headers)
+        response = conn.getresponse()
+        return (response, response.read())
+    finally:
+        conn.close()
 
 class TestGET(unittest.TestCase):
 
@@ -60,6 +83,230 @@ class TestGET(unittest.TestCase):
         self.assertEquals(obj['results'][2]['x'], 1, str)
 
 
+    def test_more_exhausted(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs' : '[{"x" : 1},{"x" : 2}]'},
+             async = False)
+
+        str = GET("http://localhost:27080/test/mongoose/_find",
+                  {"batch_size" : 2})
+        obj = json.loads(str)
+
+        self.assertEquals(len(obj['results']), 2, str)
+
+        # the last batch was full, the next one is just empty
+        str = GET("http://localhost:27080/test/mongoose/_more",
+                  {"id" : obj['id'], "batch_size" : 2})
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 1, str)
+        self.assertEquals(obj['results'], [], str)
+
+
+    def test_find_bson(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs' : '[{"x" : 1},{"x" : 2},{"x" : 3}]'},
+             async = False)
+
+        (response, body) = request("GET", "/test/mongoose/_find",
+                                   {"format" : "bson", "batch_size" : 2, "sort" : '{"x" : 1}'})
+        docs = decode_all(body)
+
+        self.assertEquals(response.getheader("Content-Type"), "application/bson")
+        self.assertEquals(docs[0]['ok'], 1, docs)
+        self.assertEquals(docs[0]['ndocs'], 2, docs)
+        self.assertEquals(response.getheader("X-Cursor-Id"), "%d" % docs[0]['id'])
+        self.assertEquals([doc['x'] for doc in docs[1:]], [1, 2], docs)
+
+        id = docs[0]['id']
+        (response, body) = request("GET", "/test/mongoose/_more",
+                                   {"format" : "bson", "batch_size" : 2, "id" : id})
+        docs = decode_all(body)
+
+        self.assertEquals(response.getheader("X-Cursor-Id"), "%d" % id)
+        self.assertEquals(docs[0]['ndocs'], 1, docs)
+        self.assertEquals([doc['x'] for doc in docs[1:]], [3], docs)
+
+
+    def test_batch_bson(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs' : '[{"x" : 1},{"x" : 2}]'},
+             async = False)
+
+        requests = [{"cmd" : "_find", "db" : "test", "collection" : "mongoose",
+                     "args" : {"sort" : ['{"x" : 1}']}},
+                    {"cmd" : "_hello"},
+                    {"cmd" : "_find", "method" : "POST", "db" : "test", "collection" : "mongoose"}]
+
+        for parallel in ["", "1"]:
+            (response, body) = request("POST", "/_batch",
+                                       {"format" : "bson", "requests" : json.dumps(requests),
+                                        "parallel" : parallel})
+            docs = decode_all(body)
+
+            self.assertEquals(response.getheader("Content-Type"), "application/bson")
+
+            # each sub-request's envelope, then its documents
+            self.assertEquals(docs[0]['ndocs'], 2, docs)
+            self.assertEquals([doc['x'] for doc in docs[1:3]], [1, 2], docs)
+            self.assertEquals(docs[3]['ok'], 1, docs)
+            self.assertEquals(docs[3]['ndocs'], 0, docs)
+            # a POST isn't told the format, its json error still comes back
+            # as bson
+            self.assertEquals(docs[4]['ok'], 0, docs)
+            self.assertEquals(docs[4]['errmsg'], "_find must be a GET request", docs)
+            self.assertEquals(len(docs), 5, docs)
+
+
+    def test_compression(self):
+        docs = [{"x" : x, "padding" : "." * 100} for x in range(200)]
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs' : json.dumps(docs)},
+             async = False)
+
+        # too small to bother with, so it goes out whole
+        (response, body) = request("GET", "/_hello", {}, {"Accept-Encoding" : "gzip"})
+
+        self.assertEquals(response.getheader("Content-Encoding"), None)
+        self.assertEquals(response.getheader("Content-Length"), "%d" % len(body))
+
+        # too big to buffer, so it's chunked
+        (response, body) = request("GET", "/test/mongoose/_find", {"batch_size" : 200},
+                                   {"Accept-Encoding" : "deflate;q=0.5, gzip"})
+
+        self.assertEquals(response.getheader("Content-Encoding"), "gzip")
+        self.assertEquals(response.getheader("Transfer-Encoding"), "chunked")
+        self.assertEquals(response.getheader("Content-Length"), None)
+        obj = json.loads(zlib.decompress(body, 16 + zlib.MAX_WBITS))
+        self.assertEquals(len(obj['results']), 200)
+
+        (response, body) = request("GET", "/test/mongoose/_find", {"batch_size" : 200},
+                                   {"Accept-Encoding" : "gzip;q=0, deflate"})
+
+        self.assertEquals(response.getheader("Content-Encoding"), "deflate")
+        obj = json.loads(zlib.decompress(body))
+        self.assertEquals(len(obj['results']), 200)
+
+        for accept in ["gzip;q=0", "gzip;q=0, deflate;q=0", "identity"]:
+            (response, body) = request("GET", "/test/mongoose/_find", {"batch_size" : 200},
+                                       {"Accept-Encoding" : accept})
+
+            self.assertEquals(response.getheader("Content-Encoding"), None, accept)
+            self.assertEquals(len(json.loads(body)['results']), 200, accept)
+
+
+    def test_static(self):
+        # favicon.ico is in the docroot when httpd.py is run from the top
+        # of the repo
+        (response, body) = request("GET", "/favicon.ico", {})
+        size = len(body)
+        etag = response.getheader("ETag")
+
+        self.assertEquals(response.status, 200)
+        self.assertEquals(response.getheader("Content-Type"), "image/vnd.microsoft.icon")
+        self.assertEquals(response.getheader("Accept-Ranges"), "bytes")
+
+        (response, body) = request("GET", "/favicon.ico", {}, {"If-None-Match" : etag})
+
+        self.assertEquals(response.status, 304)
+        self.assertEquals(body, "")
+
+        (response, body) = request("GET", "/favicon.ico", {}, {"Range" : "bytes=0-9"})
+
+        self.assertEquals(response.status, 206)
+        self.assertEquals(response.getheader("Content-Range"), "bytes 0-9/%d" % size)
+        self.assertEquals(len(body), 10)
+
+        (response, body) = request("GET", "/favicon.ico", {}, {"Range" : "bytes=%d-" % size})
+
+        self.assertEquals(response.status, 416)
+        self.assertEquals(response.getheader("Content-Range"), "bytes */%d" % size)
+
+        (response, body) = request("GET", "/..%2f..%2fetc%2fpasswd.html", {})
+
+        self.assertEquals(response.status, 404)
+
+
+    def test_metrics(self):
+        GET("http://localhost:27080/test/mongoose/_find")
+        GET("http://localhost:27080/test/mongoose/_find", {"criteria" : "not json"})
+
+        str = GET("http://localhost:27080/_metrics")
+
+        self.assertTrue('sleepymongoose_request_seconds_bucket{op="_find",le="+Inf"}' in str, str)
+        self.assertTrue('sleepymongoose_request_seconds_count{op="_find"}' in str, str)
+        # the input after the colon isn't part of the label
+        self.assertTrue('sleepymongoose_errors_total{op="_find",errmsg="couldn\'t parse json"}' in str, str)
+
+
+    def test_find_keyset(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs' : '[{"x" : 1},{"x" : 2},{"x" : 2},{"x" : 3},{"x" : 4}]'},
+             async = False)
+
+        str = GET("http://localhost:27080/test/mongoose/_find",
+                  {"sort" : '{"x" : 1}', "batch_size" : 2, "keyset" : 1})
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 1, str)
+        self.assertEquals([doc['x'] for doc in obj['results']], [1, 2], str)
+
+        str = GET("http://localhost:27080/test/mongoose/_find",
+                  {"sort" : '{"x" : 1}', "batch_size" : 2, "after" : obj['next']})
+        obj = json.loads(str)
+
+        self.assertEquals([doc['x'] for doc in obj['results']], [2, 3], str)
+
+        str = GET("http://localhost:27080/test/mongoose/_find",
+                  {"sort" : '{"x" : 1}', "batch_size" : 2, "after" : obj['next']})
+        obj = json.loads(str)
+
+        self.assertEquals([doc['x'] for doc in obj['results']], [4], str)
+        self.assertEquals(obj['next'], None, str)
+
+        for batch_size in [0, -1]:
+            str = GET("http://localhost:27080/test/mongoose/_find",
+                      {"sort" : '{"x" : 1}', "batch_size" : batch_size, "keyset" : 1})
+            obj = json.loads(str)
+
+            self.assertEquals(obj['ok'], 0, str)
+
+
+    def test_tail(self):
+        POST("http://localhost:27080/test/_cmd",
+             params = {'cmd' : '{"drop" : "mongoose_capped"}'})
+        POST("http://localhost:27080/test/_cmd",
+             params = {'cmd' : '{"create" : "mongoose_capped", "capped" : true, "size" : 100000}'})
+        POST("http://localhost:27080/test/mongoose_capped/_insert",
+             params={'docs' : '[{"x" : 1}]'},
+             async = False)
+
+        # only what's added after the first call
+        str = GET("http://localhost:27080/test/mongoose_capped/_tail",
+                  {"timeout" : 1})
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 1, str)
+        self.assertEquals(obj['results'], [], str)
+
+        POST("http://localhost:27080/test/mongoose_capped/_insert",
+             params={'docs' : '[{"x" : 2}]'},
+             async = False)
+
+        str = GET("http://localhost:27080/test/mongoose_capped/_tail",
+                  {"timeout" : 5, "after" : obj['next']})
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 1, str)
+        self.assertEquals([doc['x'] for doc in obj['results']], [2], str)
+
+        str = GET("http://localhost:27080/test/mongoose_capped/_tail",
+                  {"timeout" : "soon"})
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 0, str)
+
+
 
 
 if __name__ == '__main__':
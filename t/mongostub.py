@@ -0,0 +1,556 @@
+"""
+An in-process stand-in for a pymongo 2.x Connection, so the gateway can be
+run (and benchmarked) without a mongod.  It keeps documents in memory and
+supports what MongoHandler uses: find with criteria, fields, sort, limit and
+skip; tailable cursors; insert, update and remove; the bulk API; and a few
+commands.
+
+Criteria can use equality, $gt/$gte/$lt/$lte/$ne/$in/$nin/$exists, and $or
+or $and.  Updates can use $set, $unset and $inc or replace the document.
+
+Set MongoStub.latency to add a simulated round trip to every operation (and
+to every batch read from a cursor).
+"""
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, OperationFailure
+
+import collections
+import threading
+import time
+
+
+def _get(doc, key):
+    for part in key.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return (False, None)
+        doc = doc[part]
+    return (True, doc)
+
+
+def _matches(doc, criteria):
+    for (key, cond) in (criteria or {}).items():
+        if key == "$or":
+            if not any(_matches(doc, c) for c in cond):
+                return False
+            continue
+        if key == "$and":
+            if not all(_matches(doc, c) for c in cond):
+                return False
+            continue
+
+        (found, value) = _get(doc, key)
+        if isinstance(cond, dict) and len(cond) > 0 and cond.keys()[0].startswith('$'):
+            for (op, arg) in cond.items():
+                if op == "$exists":
+                    ok = found == bool(arg)
+                elif op == "$ne" and arg == None:
+                    ok = found and value != None
+                elif op == "$ne":
+                    ok = not found or value != arg
+                elif op == "$in":
+                    ok = found and value in arg
+                elif op == "$nin":
+                    ok = not found or value not in arg
+                elif not found:
+                    ok = False
+                elif op == "$gt":
+                    ok = value > arg
+                elif op == "$gte":
+                    ok = value >= arg
+                elif op == "$lt":
+                    ok = value < arg
+                elif op == "$lte":
+                    ok = value <= arg
+                else:
+                    raise OperationFailure("unsupported operator: %s" % op)
+                if not ok:
+                    return False
+        elif not found or value != cond:
+            return False
+
+    return True
+
+
+_missing = object()
+
+def _predicate(criteria):
+    """
+    a function that says whether a document matches criteria, so the stub's
+    own matching costs as little of the benchmark as possible
+    """
+    if not criteria:
+        return lambda doc: True
+
+    simple = True
+    for (key, cond) in criteria.items():
+        if key.startswith('$') or '.' in key or isinstance(cond, dict):
+            simple = False
+
+    if simple and len(criteria) == 1:
+        (key, value) = criteria.items()[0]
+        return lambda doc: doc.get(key, _missing) == value
+    if simple:
+        items = criteria.items()
+        return lambda doc: all(doc.get(k, _missing) == v for (k, v) in items)
+
+    return lambda doc: _matches(doc, criteria)
+
+
+def _project(doc, fields):
+    if not fields:
+        return doc
+
+    if isinstance(fields, (list, tuple)):
+        fields = dict((f, 1) for f in fields)
+
+    include = [f for (f, v) in fields.items() if v and f != "_id"]
+    if len(include) > 0:
+        result = {}
+        for f in include:
+            if f in doc:
+                result[f] = doc[f]
+        if fields.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+
+    # only _id, or only exclusions
+    return dict((k, v) for (k, v) in doc.items() if fields.get(k, 1))
+
+
+def _apply(doc, update):
+    if len(update) == 0 or not update.keys()[0].startswith('$'):
+        new = dict(update)
+        if "_id" in doc:
+            new["_id"] = doc["_id"]
+        doc.clear()
+        doc.update(new)
+        return
+
+    for (op, changes) in update.items():
+        for (key, value) in changes.items():
+            if op == "$set":
+                doc[key] = value
+            elif op == "$unset":
+                doc.pop(key, None)
+            elif op == "$inc":
+                doc[key] = doc.get(key, 0) + value
+            else:
+                raise OperationFailure("unsupported update operator: %s" % op)
+
+
+class MongoStubCursor:
+
+    def __init__(self, collection, criteria, fields, limit, skip):
+        self.collection = collection
+        self.criteria = criteria
+        self.fields = fields
+        self.limit = limit
+        self.skip = skip
+        self.order = None
+        self.docs = None
+        self.position = 0
+        self.closed = False
+
+    def sort(self, key, direction = None):
+        if direction != None:
+            key = [(key, direction)]
+        self.order = key
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def _run(self):
+        self.collection.stub._wait()
+        docs = self.collection._select(self.criteria)
+        for (key, direction) in reversed(self.order or []):
+            if key == "$natural":
+                if direction < 0:
+                    docs.reverse()
+                continue
+            docs.sort(key = lambda d: _get(d, key)[1], reverse = direction < 0)
+
+        docs = docs[self.skip:]
+        if self.limit:
+            docs = docs[:abs(self.limit)]
+        self.docs = [_project(d, self.fields) for d in docs]
+
+    def next(self):
+        if self.closed:
+            raise StopIteration
+        if self.docs == None:
+            self._run()
+        if self.position >= len(self.docs):
+            raise StopIteration
+
+        # a getmore every 101 documents
+        if self.position > 0 and self.position % 101 == 0:
+            self.collection.stub._wait()
+
+        doc = self.docs[self.position]
+        self.position = self.position + 1
+        return doc
+
+    def __iter__(self):
+        return self
+
+    @property
+    def alive(self):
+        return not self.closed and (self.docs == None or self.position < len(self.docs))
+
+    def close(self):
+        self.closed = True
+
+    def count(self):
+        return len(self.collection._select(self.criteria))
+
+    def explain(self):
+        if self.docs == None:
+            self._run()
+        return {"cursor" : "BasicCursor", "n" : len(self.docs),
+                "nscanned" : len(self.collection.docs)}
+
+
+class MongoStubTailCursor:
+    """
+    a tailable, await_data cursor: it returns documents in the order they
+    were inserted, then waits up to await_seconds for more before giving up
+    (for now) with StopIteration
+    """
+
+    await_seconds = 1
+
+    def __init__(self, collection, criteria, await_data = True):
+        self.collection = collection
+        self.criteria = criteria
+        self.await_data = await_data
+        # inserts seen so far
+        self.position = 0
+        # named like pymongo's, so MongoHandler can see what's buffered
+        self._Cursor__data = collections.deque()
+        self.closed = False
+
+    def next(self):
+        if self.closed:
+            raise StopIteration
+        if len(self._Cursor__data) == 0:
+            self._get_more()
+        if len(self._Cursor__data) == 0:
+            raise StopIteration
+        return self._Cursor__data.popleft()
+
+    def _get_more(self):
+        self.collection.stub._wait()
+        deadline = time.time()
+        if self.await_data:
+            deadline = deadline + self.await_seconds
+        matches = _predicate(self.criteria)
+        while True:
+            coll = self.collection
+            coll.lock.acquire()
+            try:
+                new = coll.docs[max(0, self.position - coll.dropped):]
+                self.position = coll.dropped + len(coll.docs)
+            finally:
+                coll.lock.release()
+
+            self._Cursor__data.extend(d for d in new if matches(d))
+            if len(self._Cursor__data) > 0 or time.time() >= deadline:
+                return
+            time.sleep(0.005)
+
+    def sort(self, key, direction = None):
+        # only $natural, which is the order it reads in anyway
+        return self
+
+    def __iter__(self):
+        return self
+
+    @property
+    def alive(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class MongoStubBulk:
+
+    def __init__(self, collection, ordered):
+        self.collection = collection
+        self.ordered = ordered
+        self.ops = []
+
+    def insert(self, doc):
+        if "_id" not in doc:
+            doc["_id"] = ObjectId()
+        self.ops.append(("insert", doc))
+
+    def find(self, selector):
+        return MongoStubBulkSelector(self, selector)
+
+    def execute(self):
+        self.collection.stub._wait()
+        result = {"nInserted" : 0, "nUpserted" : 0, "nMatched" : 0,
+                  "nModified" : 0, "nRemoved" : 0, "upserted" : [],
+                  "writeErrors" : [], "writeConcernErrors" : []}
+
+        for (index, (op, arg)) in enumerate(self.ops):
+            try:
+                if op == "insert":
+                    self.collection.insert(arg, _wait = False)
+                    result["nInserted"] += 1
+                elif op == "update":
+                    (selector, update, multi, upsert) = arg
+                    n = self.collection._update(selector, update, upsert, multi)
+                    if n == 0 and upsert:
+                        result["nUpserted"] += 1
+                        result["upserted"].append({"index" : index})
+                    else:
+                        result["nMatched"] += n
+                        result["nModified"] += n
+                else:
+                    (selector, multi) = arg
+                    result["nRemoved"] += self.collection._remove(selector, multi)
+            except OperationFailure, e:
+                result["writeErrors"].append({"index" : index, "code" : e.code or 2,
+                                              "errmsg" : "%s" % e, "op" : arg})
+                if self.ordered:
+                    break
+
+        if len(result["writeErrors"]) > 0:
+            raise BulkWriteError(result)
+        return result
+
+
+class MongoStubBulkSelector:
+
+    def __init__(self, bulk, selector, upsert = False):
+        self.bulk = bulk
+        self.selector = selector
+        self.is_upsert = upsert
+
+    def upsert(self):
+        return MongoStubBulkSelector(self.bulk, self.selector, True)
+
+    def update(self, update):
+        self.bulk.ops.append(("update", (self.selector, update, True, self.is_upsert)))
+
+    def update_one(self, update):
+        self.bulk.ops.append(("update", (self.selector, update, False, self.is_upsert)))
+
+    def replace_one(self, doc):
+        self.bulk.ops.append(("update", (self.selector, doc, False, self.is_upsert)))
+
+    def remove(self):
+        self.bulk.ops.append(("remove", (self.selector, True)))
+
+    def remove_one(self):
+        self.bulk.ops.append(("remove", (self.selector, False)))
+
+
+class MongoStubCollection:
+
+    def __init__(self, stub, name):
+        self.stub = stub
+        self.name = name
+        self.docs = []
+        self.ids = set()
+        # documents trimmed off the front to stay under max_docs
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def _select(self, criteria):
+        self.lock.acquire()
+        try:
+            matches = _predicate(criteria)
+            return [d for d in self.docs if matches(d)]
+        finally:
+            self.lock.release()
+
+    def find(self, spec = None, fields = None, limit = 0, skip = 0, tailable = False, **kwargs):
+        if tailable:
+            return MongoStubTailCursor(self, spec, kwargs.get("await_data", False))
+        return MongoStubCursor(self, spec, fields, limit, skip)
+
+    def find_one(self, spec = None, fields = None, **kwargs):
+        for doc in self.find(spec, fields, limit=1):
+            return doc
+        return None
+
+    def insert(self, docs, _wait = True, **kwargs):
+        if _wait:
+            self.stub._wait()
+
+        single = isinstance(docs, dict)
+        if single:
+            docs = [docs]
+
+        self.lock.acquire()
+        try:
+            for doc in docs:
+                if "_id" not in doc:
+                    doc["_id"] = ObjectId()
+                if doc["_id"] in self.ids:
+                    raise OperationFailure("E11000 duplicate key error index: _id_ dup key: { : %r }" % doc["_id"], 11000)
+                self.ids.add(doc["_id"])
+                self.docs.append(doc)
+
+            # keep long benchmarks from eating all the memory
+            while len(self.docs) > self.stub.max_docs:
+                self.ids.discard(self.docs.pop(0).get("_id"))
+                self.dropped = self.dropped + 1
+        finally:
+            self.lock.release()
+
+        self.stub.last_n = len(docs)
+        if single:
+            return docs[0]["_id"]
+        return [doc["_id"] for doc in docs]
+
+    def _update(self, spec, document, upsert, multi):
+        self.lock.acquire()
+        try:
+            n = 0
+            for doc in self.docs:
+                if _matches(doc, spec):
+                    _apply(doc, document)
+                    n = n + 1
+                    if not multi:
+                        break
+        finally:
+            self.lock.release()
+
+        if n == 0 and upsert:
+            doc = dict((k, v) for (k, v) in spec.items() if not k.startswith('$'))
+            _apply(doc, document)
+            self.insert(doc, _wait = False)
+        return n
+
+    def update(self, spec, document, upsert = False, multi = False, **kwargs):
+        self.stub._wait()
+        self.stub.last_n = self._update(spec, document, upsert, multi)
+
+    def _remove(self, spec, multi = True):
+        self.lock.acquire()
+        try:
+            kept = []
+            n = 0
+            for doc in self.docs:
+                if (multi or n == 0) and _matches(doc, spec):
+                    self.ids.discard(doc.get("_id"))
+                    n = n + 1
+                else:
+                    kept.append(doc)
+            self.docs = kept
+        finally:
+            self.lock.release()
+        return n
+
+    def remove(self, spec = None, **kwargs):
+        self.stub._wait()
+        self.stub.last_n = self._remove(spec)
+        return {"ok" : 1, "n" : self.stub.last_n}
+
+    def initialize_unordered_bulk_op(self):
+        return MongoStubBulk(self, False)
+
+    def initialize_ordered_bulk_op(self):
+        return MongoStubBulk(self, True)
+
+
+class MongoStubDatabase:
+
+    def __init__(self, stub, name):
+        self.stub = stub
+        self.name = name
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        self.lock.acquire()
+        try:
+            if name not in self.collections:
+                self.collections[name] = MongoStubCollection(self.stub, name)
+            return self.collections[name]
+        finally:
+            self.lock.release()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def command(self, cmd, check = True, **kwargs):
+        self.stub._wait()
+        if isinstance(cmd, basestring):
+            cmd = {cmd : 1}
+
+        name = cmd.keys()[0]
+        if name in ("ping", "ismaster", "isMaster", "buildinfo", "getlasterror"):
+            return {"ok" : 1}
+        if name == "count":
+            return {"ok" : 1, "n" : len(self[cmd[name]]._select(cmd.get("query")))}
+        if name == "drop":
+            self.lock.acquire()
+            self.collections.pop(cmd[name], None)
+            self.lock.release()
+            return {"ok" : 1}
+
+        result = {"ok" : 0, "errmsg" : "no such cmd: %s" % name}
+        if check:
+            raise OperationFailure(result["errmsg"])
+        return result
+
+    def last_status(self):
+        return {"ok" : 1, "err" : None, "n" : self.stub.last_n}
+
+    def authenticate(self, username, password):
+        return True
+
+
+class MongoStub:
+
+    # seconds to sleep per round trip
+    latency = 0
+
+    # documents kept per collection, oldest are dropped first
+    max_docs = 50000
+
+    def __init__(self, host = "localhost", port = 27017, **kwargs):
+        if isinstance(host, basestring):
+            # the first host of a host list or mongodb:// uri
+            if host.startswith("mongodb://"):
+                host = host[len("mongodb://"):]
+            host = host.rpartition("@")[2].partition("/")[0].split(",")[0]
+            if ":" in host:
+                (host, sep, port) = host.rpartition(":")
+                port = int(port)
+        self.host = host or "localhost"
+        self.port = port
+        self.max_bson_size = 16 * 1024 * 1024
+        self.last_n = 0
+        self.databases = {}
+        self.lock = threading.Lock()
+
+    def _wait(self):
+        if MongoStub.latency > 0:
+            time.sleep(MongoStub.latency)
+
+    def __getitem__(self, name):
+        self.lock.acquire()
+        try:
+            if name not in self.databases:
+                self.databases[name] = MongoStubDatabase(self, name)
+            return self.databases[name]
+        finally:
+            self.lock.release()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def close(self):
+        pass
@@ -1,8 +1,21 @@
 from restclient import GET, POST
+from bson import BSON
 
+import httplib
 import json
 import unittest
 
+def POST_body(path, body, content_type):
+    """
+    POST a raw body, which restclient can only send as a form
+    """
+    conn = httplib.HTTPConnection("localhost", 27080)
+    try:
+        conn.request("POST", path, body, {"Content-Type" : content_type})
+        return conn.getresponse().read()
+    finally:
+        conn.close()
+
 class TestPOST(unittest.TestCase):
 
     def setUp(self):
@@ -59,6 +72,57 @@ class TestPOST(unittest.TestCase):
 
         self.assertEquals(type(obj['oids'][0]['$oid']).__name__, "unicode")
 
+    def test_insert_ndjson(self):
+        body = ('{"x" : 1}\n'
+                '{"x" : 2}\n'
+                'not json\n'
+                '\n'
+                '[1]\n'
+                '{"x" : 3}\n')
+        str = POST_body("/test/mongoose/_insert?chunk_docs=2", body, "application/x-ndjson")
+
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 0, str)
+        self.assertEquals(obj['n'], 3, str)
+        self.assertEquals([chunk['n'] for chunk in obj['chunks']], [2, 1], str)
+        self.assertEquals(obj['chunks'][0]['errors'], [], str)
+        self.assertEquals(obj['chunks'][1]['errors'],
+                          [{"line" : 3, "errmsg" : "couldn't parse json"},
+                           {"line" : 5, "errmsg" : "not a document"}], str)
+
+        str = GET("http://localhost:27080/test/mongoose/_find",
+                  {"sort" : '{"x" : 1}'})
+        obj = json.loads(str)
+
+        self.assertEquals([doc['x'] for doc in obj['results']], [1, 2, 3], str)
+
+        str = POST_body("/test/mongoose/_insert?chunk_docs=some", body, "application/x-ndjson")
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 0, str)
+        self.assertEquals(obj['errmsg'], "chunk_docs and chunk_bytes must be numbers", str)
+
+    def test_insert_bson(self):
+        body = BSON.encode({"x" : 1}) + BSON.encode({"x" : 2})
+        str = POST_body("/test/mongoose/_insert", body, "application/bson")
+
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 1, str)
+        self.assertEquals(obj['n'], 2, str)
+
+        # there's no finding the next document after a bad length
+        body = BSON.encode({"x" : 3}) + "\x02\x00\x00\x00" + BSON.encode({"x" : 4})
+        str = POST_body("/test/mongoose/_insert", body, "application/bson")
+
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 0, str)
+        self.assertEquals(obj['n'], 1, str)
+        self.assertEquals(obj['chunks'][0]['errors'],
+                          [{"doc" : 2, "errmsg" : "invalid document length: 2"}], str)
+
     def test_safe_insert(self):
         str = POST("http://localhost:27080/test/mongoose/_insert",
                    params = {'docs' : '[{"foo" : "bar"}]', 'safe' : 1},
@@ -153,6 +217,31 @@ class TestPOST(unittest.TestCase):
         self.assertEquals(obj['n'], 0)
         self.assertEquals(obj['err'], None)
 
+    def test_update_bson(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params = {"docs" : '[{"x" : 1}]'},
+             async = False )
+
+        # criteria, then newobj
+        body = BSON.encode({"x" : 1}) + BSON.encode({"$set" : {"y" : 2}})
+        str = POST_body("/test/mongoose/_update?safe=1", body, "application/bson")
+
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 1, str)
+        self.assertEquals(obj['n'], 1, str)
+
+        str = GET("http://localhost:27080/test/mongoose/_find")
+        obj = json.loads(str)
+
+        self.assertEquals(obj['results'][0]['y'], 2, str)
+
+        str = POST_body("/test/mongoose/_update", BSON.encode({"x" : 1}), "application/bson")
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 0, str)
+        self.assertEquals(obj['errmsg'], "expected criteria and newobj documents, got 1", str)
+
     def test_upsert(self):
         str = POST("http://localhost:27080/test/mongoose/_update",
                    params = {"criteria" : "{}", "newobj" : '{"$set" : {"x" : 1}}', "upsert" : "1", "safe" : "1"},
@@ -221,6 +310,92 @@ class TestPOST(unittest.TestCase):
         self.assertEquals(obj['ok'], 1, str)
         self.assertEquals(obj['n'], 1, str)
 
+    def test_bulk(self):
+        ops = [{"op" : "insert", "doc" : {"_id" : 1, "x" : 1}},
+               {"op" : "update", "criteria" : {"x" : 1}, "newobj" : {"$set" : {"y" : 1}}},
+               {"op" : "update", "criteria" : {"x" : 2}, "newobj" : {"$set" : {"y" : 2}}, "upsert" : True},
+               {"op" : "insert", "doc" : {"_id" : 1}},
+               {"op" : "remove", "criteria" : {"x" : 2}}]
+
+        str = POST("http://localhost:27080/test/mongoose/_bulk",
+                   params = {"ops" : json.dumps(ops)},
+                   async = False )
+
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 0, str)
+        self.assertEquals(obj['nInserted'], 1, str)
+        self.assertEquals(obj['nUpserted'], 1, str)
+        self.assertEquals(obj['writeErrors'][0]['index'], 3, str)
+        self.assertEquals([r['ok'] for r in obj['results']], [1, 1, 1, 0, 0], str)
+        self.assertEquals(obj['results'][0]['_id'], 1, str)
+
+        str = POST("http://localhost:27080/test/mongoose/_bulk",
+                   params = {"ops" : json.dumps(ops), "ordered" : "0"},
+                   async = False )
+
+        obj = json.loads(str)
+
+        self.assertEquals(obj['nRemoved'], 1, str)
+        self.assertEquals([r['ok'] for r in obj['results']], [0, 1, 1, 0, 1], str)
+
+        str = POST("http://localhost:27080/test/mongoose/_bulk",
+                   params = {"ops" : json.dumps(ops), "ordered" : "maybe"},
+                   async = False )
+
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 0, str)
+
+    def test_batch_parallel(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params = {"docs" : json.dumps([{"x" : x} for x in range(10)])},
+             async = False )
+
+        requests = []
+        for x in range(10):
+            requests.append({"cmd" : "_find", "db" : "test", "collection" : "mongoose",
+                             "args" : {"criteria" : [json.dumps({"x" : x})]}})
+        requests.insert(5, {"cmd" : "_hello"})
+
+        str = POST("http://localhost:27080/_batch",
+                   params = {"requests" : json.dumps(requests), "parallel" : "1",
+                             "concurrency" : "4"},
+                   async = False )
+
+        obj = json.loads(str)
+
+        # answered in the order they were asked, however they finished
+        self.assertEquals(len(obj), 11, str)
+        self.assertEquals(obj[5]['ok'], 1, str)
+        self.assertTrue('msg' in obj[5], str)
+        del obj[5]
+        self.assertEquals([result['results'][0]['x'] for result in obj], range(10), str)
+
+    def test_killcursors(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params = {"docs" : '[{"x" : 1},{"x" : 2},{"x" : 3}]'},
+             async = False )
+
+        str = GET("http://localhost:27080/test/mongoose/_find",
+                  {"batch_size" : 1})
+        id = json.loads(str)['id']
+
+        str = POST("http://localhost:27080/_killcursors",
+                   params = {"ids" : json.dumps([id])},
+                   async = False )
+
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 1, str)
+        self.assertEquals(obj['killed'], 1, str)
+
+        str = GET("http://localhost:27080/test/mongoose/_more",
+                  {"id" : id})
+        obj = json.loads(str)
+
+        self.assertEquals(obj['ok'], 0, str)
+
 
 if __name__ == '__main__':
     unittest.main()